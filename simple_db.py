@@ -28,7 +28,9 @@
 # Notes:
 #   o Uses btree module for DB engine.
 #   o JSON is the default row storage format
-#   o USE_JSON = False for umsgpack row storage format (more compact)
+#   o codec="umsgpack" for umsgpack row storage format (more compact)
+#     The codec is saved in the database, files always use the codec
+#     that created them (see recode)
 #
 ################################################################################
 
@@ -36,6 +38,21 @@ import time
 
 ## Required for load/dump
 import json
+## Page tokens
+import binascii
+
+## Back end independent helpers, shared with simple_db_btrees.py
+from simple_db_common import META_TABLE, INDEX_TABLE, INDEX_NAME_SEPARATOR, \
+                             RESERVED_PREFIX, CODEC_META, KEY_ENCODING_META, \
+                             CATALOG_META, FILE_META, KEY_ENCODING_TEXT, \
+                             KEY_ENCODING_TUPLE, KEY_PREFIX_END, \
+                             encode_tuple_key, decode_tuple_key, COMMIT_AUTO, \
+                             COMMIT_MANUAL, COMMIT_GROUP, GROUP_COMMIT_WRITES, \
+                             GROUP_COMMIT_MS, BULK_LOAD_BATCH_SIZE, ticks_ms, \
+                             ticks_diff, CODECS, DEFAULT_CODEC, \
+                             UniqueIndexError, RowCache, copy_row, RawRow, \
+                             match_row, project_row, item_values, read_page, \
+                             row_value, aggregate_specs, RowAggregate
 
 ## Default valules
 KEY_SEPARATOR = "."
@@ -43,41 +60,49 @@ DUMP_SEPARATOR = "~"
 DATE_FORMAT = "{:04d}-{:02d}-{:02d}"
 TIME_FORMAT = "{:02d}:{:02d}:{:02d}"
 
-USE_JSON = True
 btree = None
-dumps = None
-loads = None
-
-if USE_JSON :
-    ## Use json module for row serialization
-    print ("Using json module")
-    try :
-        import btree
-        dumps = lambda row_data : bytes (json.dumps (row_data).encode())
-        loads = lambda row : json.loads (row.decode())
-    except Exception as e :
-        print (e)
-else :
-    ## Use umsgpack module for row serialization
-    print ("Using umsgpack module")
-    try :
-        import umsgpack
-        import btree
-        dumps = lambda row_data : umsgpack.dumps(row_data)
-        loads = lambda row : umsgpack.loads(row)
-    except Exception as e :
-        print (e)
+try :
+    import btree
+except Exception as e :
+    print (e)
 
 simpledb_available = btree is not None
 
 ##
 class SimpleDB :
-    def __init__ (self,db_file_path,key_separator=KEY_SEPARATOR,dump_separator=DUMP_SEPARATOR,auto_commit=True) :
+    def __init__ (self,db_file_path,key_separator=KEY_SEPARATOR,dump_separator=DUMP_SEPARATOR,auto_commit=True,
+                    commit_policy=None,group_commit_writes=GROUP_COMMIT_WRITES,group_commit_ms=GROUP_COMMIT_MS,
+                    cache_rows=0,cache_bytes=0,codec=None,key_encoding=None) :
         self.key_separator = key_separator
         self.key_low = ""
         self.key_high = "~~~~~"
+        self.key_encoding = KEY_ENCODING_TEXT
         self.dump_separator = dump_separator
-        self.auto_commit = auto_commit
+        if commit_policy is None :
+            commit_policy = COMMIT_AUTO if auto_commit else COMMIT_MANUAL
+        if commit_policy not in (COMMIT_AUTO, COMMIT_MANUAL, COMMIT_GROUP) :
+            raise ValueError ("Unknown commit_policy: " + str (commit_policy))
+        self.commit_policy = commit_policy
+        self.auto_commit = commit_policy == COMMIT_AUTO
+        self.group_commit_writes = group_commit_writes
+        self.group_commit_ms = group_commit_ms
+        self.pending_writes = 0
+        self.pending_start_ms = 0
+        self.commit_stats = {
+            "commits" : 0 ,
+            "writes" : 0 ,
+            "last_commit_writes" : 0 ,
+            "max_commit_writes" : 0
+            }
+        self.indexes = {}
+        self.schemas = {}
+        self.schema_positions = {}
+        self.catalog = {}
+        self.catalog_changed = False
+        self.set_codec (DEFAULT_CODEC if codec is None else codec)
+        self.row_cache = None
+        if cache_rows > 0 or cache_bytes > 0 :
+            self.row_cache = RowCache (cache_rows, cache_bytes)
         if btree is None :
             print ("support module(s) missing")
             #raise ???
@@ -90,12 +115,21 @@ class SimpleDB :
         except OSError:
             self.db_file = open(db_file_path, "w+b")
         self.db = btree.open (self.db_file)
+        self.open_key_encoding (key_encoding)
+        self.open_codec (codec)
+        self.indexes = self.read_meta ("indexes", {})
+        self.load_schemas ()
+        self.open_catalog ()
 
     ## Return configuration
     def get_configuration (self) :
         return {
             "key_separator" : self.key_separator ,
             "dump_separator" : self.dump_separator ,
+            "commit_policy" : self.commit_policy ,
+            "codec" : self.codec ,
+            "key_encoding" : self.key_encoding ,
+            "row_cache" : self.row_cache is not None ,
             "simpledb_available" : simpledb_available
             }
 
@@ -106,10 +140,12 @@ class SimpleDB :
             pass
         elif isinstance (key, list) :
             for _, key_value in enumerate (key) :
-                pk.append (str (key_value))
+                pk.append (key_value)
         else :
-            pk.append (str (key))
-        return bytes ((self.key_separator.join (pk)).encode ())
+            pk.append (key)
+        if self.key_encoding == KEY_ENCODING_TUPLE :
+            return encode_tuple_key (pk)
+        return bytes ((self.key_separator.join ([str (key_value) for key_value in pk])).encode ())
     def build_key_from_ids (self,table_name,pk_id=None,row_data=None) :
         key = None
         if pk_id is None :
@@ -125,76 +161,173 @@ class SimpleDB :
     ## rewrites table row from row_data
     def write_row (self,table_name,pk_id,row_data) :
         #print ("w_r:", table_name,pk)
-        db_key = self.build_key_from_ids (table_name,pk_id,row_data)
-        db_row = dumps(row_data)
+        self.store_row (table_name ,
+                        self.build_key_from_ids (table_name,pk_id,row_data) ,
+                        row_data)
+        self.commit_update ()
+    ## writes many table rows, one commit for all rows
+    # rows are sorted by btree key before they are written
+    # Keys, stored rows and unique index values of every row are checked
+    # first, a bad row raises before any row is written
+    def write_rows (self,table_name,pk_id,rows) :
+        keyed_rows = []
+        for row_data in rows :
+            keyed_rows.append ((self.build_key_from_ids (table_name,pk_id,row_data) ,
+                                row_data ,
+                                self.dump_row (table_name, row_data)))
+        keyed_rows.sort (key = lambda keyed_row : keyed_row [0])
+        self.check_unique_rows (table_name, keyed_rows)
+        for db_key, row_data, db_row in keyed_rows :
+            self.store_row (table_name, db_key, row_data, db_row)
+        self.commit_update (len (keyed_rows))
+        return len (keyed_rows)
+    ## Raises UniqueIndexError if storing keyed_rows in order would fail,
+    # the index entries are followed as store_row would change them
+    def check_unique_rows (self,table_name,keyed_rows) :
+        if table_name not in self.indexes :
+            return
+        owners = {}         # unique entry key : db_key, changed by earlier rows
+        batch_rows = {}     # db_key : earlier row_data
+        for db_key, row_data, _ in keyed_rows :
+            if db_key in batch_rows :
+                old_row = batch_rows [db_key]
+            else :
+                old_row = None
+                old_db_row = self.db.get (db_key)
+                if old_db_row is not None :
+                    old_row = self.load_row (table_name, old_db_row)
+            old_entries = self.index_entries (table_name, db_key, old_row)
+            new_entries = self.index_entries (table_name, db_key, row_data)
+            for _, (entry_key, unique) in enumerate (new_entries.items ()) :
+                if not unique or entry_key in old_entries :
+                    continue
+                if entry_key in owners :
+                    owner = owners [entry_key]
+                else :
+                    owner = self.db.get (entry_key)
+                if owner is not None and owner != db_key :
+                    raise UniqueIndexError ("Duplicate unique index value: " + self.key_string (entry_key))
+            for _, (entry_key, unique) in enumerate (old_entries.items ()) :
+                if unique and entry_key not in new_entries :
+                    owners [entry_key] = None
+            for _, (entry_key, unique) in enumerate (new_entries.items ()) :
+                if unique :
+                    owners [entry_key] = db_key
+            batch_rows [db_key] = row_data
+    ## stores row_data at db_key and updates indexes, no commit
+    # db_row is row_data already dumped, None to dump it here
+    def store_row (self,table_name,db_key,row_data,db_row=None) :
+        if db_row is None :
+            db_row = self.dump_row (table_name, row_data)
+        old_db_row = self.db.get (db_key)
+        if table_name in self.indexes :
+            old_row = None
+            if old_db_row is not None :
+                old_row = self.load_row (table_name, old_db_row)
+            self.update_index_entries (db_key ,
+                                self.index_entries (table_name, db_key, old_row) ,
+                                self.index_entries (table_name, db_key, row_data))
         self.db [db_key] = db_row
-        if self.auto_commit :
-            self.commit ()
+        self.update_catalog (table_name, db_key, old_db_row, db_row)
+        if self.row_cache is not None :
+            self.row_cache.invalidate (db_key)
     ## rewrites updated table row from update_data
+    # Returns None if the row does not exist, raises UniqueIndexError
     def rewrite_row (self,table_name,key,update_data) :
         #print ("w_r:", table_name,pk)
         reply = None
         db_key = self.build_key (table_name, key)
         try :
-            db_row = self.db [db_key]    # retrive current row
-            db_row = loads (db_row)      # row to dict
+            old_db_row = self.db [db_key]    # retrive current row
+            db_row = self.load_row (table_name, old_db_row)  # row to dict
+            old_entries = self.index_entries (table_name, db_key, db_row)
             db_row.update (update_data)  # update row fields
-            reply = json.dumps (db_row)  # save reply
-            db_row = dumps (db_row)      # dict to internal format
+            new_entries = self.index_entries (table_name, db_key, db_row)
+            reply = db_row               # save reply
+            db_row = self.dump_row (table_name, db_row)      # dict to internal format
+            self.update_index_entries (db_key, old_entries, new_entries)
             self.db [db_key] = db_row    # update DB row
-        except Exception as e:
-            print  (e)
-            return None
-        if self.auto_commit :
-            self.commit ()
+            self.update_catalog (table_name, db_key, old_db_row, db_row)
+            if self.row_cache is not None :
+                self.row_cache.invalidate (db_key)
+        except KeyError :
+            return None                  # row does not exist
+        self.commit_update ()
         return reply          # return updated row
 
+    ## Returns decoded row at db_key, from the row cache if enabled
+    # raises KeyError if not found, do not modify the returned row
+    def fetch_row (self,table_name,db_key) :
+        if self.row_cache is None :
+            return self.load_row (table_name, self.db [db_key])
+        row = self.row_cache.get (db_key)
+        if row is None :
+            db_row = self.db [db_key]
+            row = self.load_row (table_name, db_row)
+            self.row_cache.put (db_key, row, len (db_row))
+        return row
+    ## Returns row cache counters, None if the row cache is not enabled
+    def get_cache_stats (self) :
+        if self.row_cache is None :
+            return None
+        return self.row_cache.get_stats ()
+
     ## read row from table/key, returns None if not found
-    def read_row (self,table_name,key) :
+    # raw=True returns a RawRow if raw_rows (table_name)
+    def read_row (self,table_name,key,raw=False) :
         #print ("read_row:", self.build_key (table_name, key))
         try :
-            #print (loads (self.db [self.build_key (table_name, key)]))
-            return loads (self.db [self.build_key (table_name, key)])
+            #print (self.loads (self.db [self.build_key (table_name, key)]))
+            if raw and self.raw_rows (table_name) :
+                return RawRow (self.db [self.build_key (table_name, key)])
+            return copy_row (self.fetch_row (table_name, self.build_key (table_name, key)))
         except Exception :
             return None
+    ## True if stored table rows are msgpack rows that need no decoding
+    def raw_rows (self,table_name) :
+        return self.codec == "umsgpack" and table_name not in self.schemas
     ## read row columns from table/key, returns None if not found
     def read_columns (self,table_name,key,column_list) :
         #print ("read_columns:", self.build_key (table_name, key), column_list)
         try :
-            row = loads (self.db [self.build_key (table_name, key)])
-            columns = {}
-            # set valid valid column id test
-            id_exists = None
-            if isinstance (row, list) :
-                id_exists = lambda col_id : col_id >= 0 and col_id < len (row)
-            else :
-                id_exists = lambda col_id : col_id in row
-            for _, col_id in enumerate (column_list) :
-                if id_exists (col_id) :
-                    columns [col_id] = row [col_id]   # Valid column id
-                else :
-                    columns [col_id] = None           # Bad column id
-            return columns
+            db_key = self.build_key (table_name, key)
+            if self.row_cache is None and table_name in self.schemas :
+                return self.read_schema_columns (table_name, db_key, column_list)
+            return project_row (self.fetch_row (table_name, db_key), column_list)
         except Exception as e :
             print (e)
             return None
 
+    ## read_columns for schema tables, only requested columns are returned
+    def read_schema_columns (self,table_name,db_key,column_list) :
+        stored_row = self.loads (self.db [db_key])
+        columns = {}
+        if isinstance (stored_row, list) :
+            positions = self.schema_positions [table_name][stored_row [0] - 1]
+            for _, col_id in enumerate (column_list) :
+                if col_id in positions :
+                    columns [col_id] = stored_row [positions [col_id]]
+                else :
+                    columns [col_id] = None           # Bad column id
+        else :
+            for _, col_id in enumerate (column_list) :
+                columns [col_id] = stored_row.get (col_id)
+        return columns
+
     ## read first table indexed row, or first row if key is not provided
     def first_row (self,table_name,key = "") :
         row_ret = None             # Not found
-        start_key = self.build_key (table_name, key)
-        for db_key in self.db.keys (start_key, # None) :
-                                    self.build_key (table_name, self.key_high)) :
-            return loads (self.db [db_key])    # returns first key row
+        start_key, end_key = self.table_key_range (table_name, key)
+        for db_key, db_row in self.db.items (start_key, end_key) :
+            return self.load_row (table_name, db_row)    # returns first key row
         return row_ret
     ## read next table indexed row, or first row if key is not provided
     def next_row (self,table_name,key = "") :
         row_ret = None             # Not found
-        start_key = self.build_key (table_name, key)
-        for db_key in self.db.keys (start_key, # None) :
-                                    self.build_key (table_name, self.key_high)) :
+        start_key, end_key = self.table_key_range (table_name, key)
+        for db_key, db_row in self.db.items (start_key, end_key) :
             if db_key != start_key :
-                return loads (self.db [db_key])
+                return self.load_row (table_name, db_row)
         return row_ret
     ## Return True if this key is in table_name
     def row_exists (self,table_name,key) :
@@ -202,116 +335,823 @@ class SimpleDB :
     ## Delete row from table
     def delete_row (self,table_name,key) :
         row_data = None
-        delete_key = self.build_key (table_name, key)
         try :
-            #print (loads (self.db [self.build_key (table_name, key)]))
-            row_data = loads (self.db [delete_key])
-            del (self.db [delete_key])
-            if self.auto_commit :
-                self.commit ()
+            row_data = self.remove_row (table_name, self.build_key (table_name, key))
+            if row_data is not None :
+                self.commit_update ()
         except Exception :
             pass
         return row_data
+    ## Delete many rows from table, one commit for all rows
+    # returns the number of rows deleted
+    def delete_rows (self,table_name,keys) :
+        db_keys = []
+        for key in keys :
+            db_keys.append (self.build_key (table_name, key))
+        db_keys.sort ()
+        deleted = 0
+        for db_key in db_keys :
+            if self.remove_row (table_name, db_key) is not None :
+                deleted += 1
+        if deleted > 0 :
+            self.commit_update (deleted)
+        return deleted
+    ## removes row at db_key and updates indexes, no commit
+    # returns the removed row, None if not found
+    def remove_row (self,table_name,db_key) :
+        if db_key not in self.db :
+            return None
+        db_row = self.db [db_key]
+        row_data = self.load_row (table_name, db_row)
+        self.update_index_entries (db_key ,
+                                self.index_entries (table_name, db_key, row_data) ,
+                                {})
+        del (self.db [db_key])
+        self.update_catalog (table_name, db_key, db_row, None)
+        if self.row_cache is not None :
+            self.row_cache.invalidate (db_key)
+        return row_data
 
-    ## Returns list of keys in table
-    def get_table_keys (self,table_name,start_key=None,end_key=None,limit=999999) :
-        key_list = []
-        key_low = start_key
-        key_high = end_key
-        if key_low is None :
-            key_low = self.key_low
-        if key_high is None :
-            key_high = self.key_high
-        #
-        for key in self.db.keys (self.build_key (table_name, key_low) ,
-                                      self.build_key (table_name, key_high)) :
-            key = str (key.decode())
-            #print ("gtk key:", key)
-            key_elements = str (key).split (self.key_separator)
-            key_list.append (key_elements [1])   # table key only
-            if len (key_list) >= limit :
+    ## Returns btree low/high keys for a table key range
+    # start_key None (or "") is the first table key,
+    # end_key None is past the last table key
+    def table_key_range (self,table_name,start_key=None,end_key=None) :
+        key_low, key_high = self.prefix_range (table_name)
+        if start_key is not None and start_key != self.key_low :
+            key_low = self.build_key (table_name, start_key)
+        if end_key is not None and end_key != self.key_high :
+            key_high = self.build_key (table_name, end_key)
+        return (key_low, key_high)
+
+    ## Generator, yields keys in table one at a time
+    def iter_table_keys (self,table_name,start_key=None,end_key=None,limit=None) :
+        key_low, key_high = self.table_key_range (table_name, start_key, end_key)
+        yield from item_values (self.iter_key_items (key_low, key_high), limit)
+    ## Generator, yields rows in table one at a time
+    # where (see match_row) skips rows, columns returns only those row columns
+    def iter_table_rows (self,table_name,start_key=None,end_key=None,limit=None,where=None,columns=None) :
+        key_low, key_high = self.table_key_range (table_name, start_key, end_key)
+        yield from item_values (self.iter_range_items (table_name, key_low, key_high, where, columns), limit)
+    ## Generator, yields rows with keys starting with key_prefix
+    # key_prefix is the first key value(s) of a composite key, "090001" or
+    # ["090001"], the rows are read with a single btree seek
+    def iter_prefix (self,table_name,key_prefix,limit=None,where=None,columns=None) :
+        key_low, key_high = self.prefix_range (table_name, key_prefix)
+        yield from item_values (self.iter_range_items (table_name, key_low, key_high, where, columns), limit)
+    ## Generator, yields [key, row] items in table one at a time
+    def iter_table_items (self,table_name,start_key=None,end_key=None,limit=None,where=None,columns=None) :
+        key_low, key_high = self.table_key_range (table_name, start_key, end_key)
+        yield from item_values (self.iter_keyed_items (table_name, key_low, key_high, where, columns), limit)
+
+    ## Scan generators, yield (btree key, value) from btree key_low up to key_high
+    # The btree key is used as the page token (see read_page)
+    def iter_key_items (self,key_low,key_high) :
+        for db_key in self.db.keys (key_low, key_high) :
+            yield (db_key, self.table_key (db_key))     # table key only
+    # raw=True yields RawRows if raw_rows (table_name) and there is no where/columns
+    def iter_range_items (self,table_name,key_low,key_high,where=None,columns=None,raw=False) :
+        if raw and where is None and columns is None and self.raw_rows (table_name) :
+            for db_key, db_row in self.db.items (key_low, key_high) :
+                yield (db_key, RawRow (db_row))
+            return
+        for db_key, db_row in self.db.items (key_low, key_high) :
+            row = self.load_row (table_name, db_row)   # table row
+            if where is not None and not match_row (row, where) :
+                continue
+            if columns is not None :
+                row = project_row (row, columns)
+            yield (db_key, row)
+    def iter_keyed_items (self,table_name,key_low,key_high,where=None,columns=None) :
+        for db_key, row in self.iter_range_items (table_name, key_low, key_high, where, columns) :
+            yield (db_key, [self.key_string (db_key), row])
+    ## Returns btree key to start a page at, page_token is a read_page next_token
+    def page_start (self,page_token,key_low) :
+        if page_token is None or page_token == "" :
+            return key_low
+        start_key = bytes (binascii.unhexlify (page_token))
+        if start_key < key_low :
+            return key_low         # token does not belong to this range
+        return start_key
+
+    ## Returns a cursor positioned at the start of the table key range
+    def cursor (self,table_name,start_key=None,end_key=None,reverse=False) :
+        return SimpleDBCursor (self, table_name, start_key, end_key, reverse)
+
+    ## Use the key encoding saved in the database, new databases save it
+    def open_key_encoding (self,key_encoding) :
+        saved_encoding = self.read_meta (KEY_ENCODING_META)
+        if saved_encoding is None :
+            if key_encoding is None :
+                key_encoding = KEY_ENCODING_TEXT
+            self.write_meta (KEY_ENCODING_META, key_encoding)
+            self.commit ()
+        else :
+            if key_encoding is not None and key_encoding != saved_encoding :
+                print ("Database key encoding is", saved_encoding, "not", key_encoding)
+            key_encoding = saved_encoding
+        if key_encoding not in (KEY_ENCODING_TEXT, KEY_ENCODING_TUPLE) :
+            raise ValueError ("Unknown key_encoding: " + str (key_encoding))
+        self.key_encoding = key_encoding
+    ## Returns list of key values from btree key, [table_name, key, ...]
+    def decode_key (self,db_key) :
+        if self.key_encoding == KEY_ENCODING_TUPLE :
+            return decode_tuple_key (db_key)
+        return str (db_key.decode ()).split (self.key_separator)
+    ## Returns table key from btree key, a list for composite keys
+    def table_key (self,db_key) :
+        key_values = self.decode_key (db_key) [1:]
+        if len (key_values) == 1 :
+            return key_values [0]
+        return key_values
+    ## Returns btree key as a string, table name and keys joined by key_separator
+    def key_string (self,db_key) :
+        if self.key_encoding == KEY_ENCODING_TUPLE :
+            return self.key_separator.join ([str (key_value) for key_value in self.decode_key (db_key)])
+        return str (db_key.decode ())
+    ## Returns btree key as dump file text, tuple keys are json arrays
+    def dump_key (self,db_key) :
+        if self.key_encoding == KEY_ENCODING_TUPLE \
+        and not db_key.startswith (RESERVED_PREFIX) :
+            return json.dumps (self.decode_key (db_key))
+        return str (db_key.decode ())
+    ## Returns btree key from dump file text, either key format is accepted
+    def load_key (self,key_text) :
+        if key_text.startswith ("[") :
+            key_values = json.loads (key_text)
+        elif self.key_encoding == KEY_ENCODING_TUPLE \
+        and not key_text.startswith (RESERVED_PREFIX.decode ()) :
+            key_values = key_text.split (self.key_separator)
+        else :
+            return bytes (key_text.encode ())
+        return self.build_key (key_values [0], key_values [1:])
+    ## Returns btree low/high keys for every key starting with table/key
+    # key is None for the whole table, a list for a composite key prefix
+    def prefix_range (self,table_name,key=None) :
+        key_low = self.build_key (table_name, key)
+        if self.key_encoding == KEY_ENCODING_TEXT :
+            key_low += self.key_separator.encode ()
+        return (key_low, key_low + KEY_PREFIX_END)
+    ## Metadata btree key, not affected by the key encoding
+    def meta_key (self,meta_name) :
+        return bytes ((META_TABLE + self.key_separator + meta_name).encode ())
+
+    ## Row codec
+    def set_codec (self,codec) :
+        if codec not in CODECS :
+            raise ValueError ("Unknown codec: " + str (codec))
+        self.dumps, self.loads = CODECS [codec] ()
+        self.codec = codec
+    ## Use the codec saved in the database, new databases save codec
+    def open_codec (self,codec) :
+        saved_codec = self.read_meta (CODEC_META)
+        if saved_codec is None :
+            ## New database, or created before the codec was saved
+            self.write_meta (CODEC_META, self.codec)
+            self.commit ()
+        elif saved_codec != self.codec :
+            if codec is not None :
+                print ("Database codec is", saved_codec, "not", codec)
+            self.set_codec (saved_codec)
+    ## Returns True for btree keys in reserved tables (metadata, indexes)
+    def is_reserved_key (self,db_key) :
+        return db_key.startswith (RESERVED_PREFIX) \
+            or db_key.startswith (self.prefix_range (INDEX_TABLE) [0])
+    ## Re-encode all rows with new_codec, take a dump_all copy first
+    # Returns the number of rows re-encoded
+    def recode (self,new_codec) :
+        if new_codec == self.codec :
+            return 0
+        old_loads = self.loads
+        self.set_codec (new_codec)
+        if self.row_cache is not None :
+            self.row_cache.clear ()
+        rows = 0
+        batch = self.read_key_batch (b"", None)
+        while len (batch) > 0 :
+            for db_key, db_row in batch :
+                if not self.is_reserved_key (db_key) :
+                    new_db_row = self.dumps (old_loads (db_row))
+                    self.db [db_key] = new_db_row
+                    self.update_catalog (self.decode_key (db_key) [0] ,
+                                            db_key, db_row, new_db_row)
+                    rows += 1
+            batch = self.read_key_batch (b"", None, after_key=batch [-1][0])
+        self.write_meta (CODEC_META, self.codec)
+        self.pending_writes += rows
+        self.commit ()
+        return rows
+
+    ## Table schemas, compact storage of dict rows
+    # Rows with exactly the columns of a schema version are stored as
+    # [version, value, value, ...], other rows are stored unchanged.
+    # New versions can only add columns, old rows are not rewritten.
+    def set_schema (self,table_name,columns) :
+        versions = self.schemas.get (table_name, [])
+        if len (versions) > 0 :
+            current = versions [-1]
+            if columns == current :
+                return len (versions)             # no change
+            if columns [:len (current)] != current :
+                raise ValueError ("New schema version can only add columns: " + table_name)
+        else :
+            key_low, key_high = self.table_key_range (table_name)
+            for db_row in self.db.values (key_low, key_high) :
+                if isinstance (self.loads (db_row), list) :
+                    raise ValueError ("Schema requires dict rows: " + table_name)
                 break
-        return key_list
-    ## Returns list of rows in a table
-    def get_table_rows (self,table_name,start_key=None,end_key=None,limit=999999) :
-        rows = []
-        key_low = start_key
-        key_high = end_key
-        if key_low is None :
-            key_low = self.key_low
-        if key_high is None :
-            key_high = self.key_high
-        #
-        for row in self.db.values (self.build_key (table_name, key_low) , # None) :
-                                      self.build_key (table_name, key_high)) :
-            rows.append (loads (row))   # table row
-            if len (rows) >= limit :
+        if len (columns) != len (set (columns)) :
+            raise ValueError ("Duplicate schema column: " + table_name)
+        versions.append (list (columns))
+        self.schemas [table_name] = versions
+        self.schema_positions [table_name] = self.build_schema_positions (versions)
+        self.write_meta ("schemas", self.schemas)
+        self.commit_update ()
+        return len (versions)
+    ## Returns list of schema versions (lists of columns), None if no schema
+    def get_schema (self,table_name) :
+        return self.schemas.get (table_name)
+    def load_schemas (self) :
+        self.schemas = self.read_meta ("schemas", {})
+        self.schema_positions = {}
+        for _, (table_name, versions) in enumerate (self.schemas.items ()) :
+            self.schema_positions [table_name] = self.build_schema_positions (versions)
+    ## Returns {column : stored position} for each schema version
+    def build_schema_positions (self,versions) :
+        version_positions = []
+        for _, columns in enumerate (versions) :
+            positions = {}
+            for position, column in enumerate (columns) :
+                positions [column] = position + 1     # [0] is the version
+            version_positions.append (positions)
+        return version_positions
+    ## Returns row_data in stored format
+    def encode_row (self,table_name,row_data) :
+        versions = self.schemas.get (table_name)
+        if versions is None :
+            return row_data
+        if not isinstance (row_data, dict) :
+            raise ValueError ("Schema requires dict rows: " + table_name)
+        version = len (versions)
+        while version > 0 :
+            columns = versions [version - 1]
+            if len (columns) == len (row_data) :
+                stored_row = [version]
+                for _, column in enumerate (columns) :
+                    if column not in row_data :
+                        break
+                    stored_row.append (row_data [column])
+                if len (stored_row) == len (columns) + 1 :
+                    return stored_row
+            version -= 1
+        return row_data            # no matching schema version
+    ## Returns stored row as a dict row
+    def decode_row (self,table_name,stored_row) :
+        if isinstance (stored_row, list) and table_name in self.schemas :
+            columns = self.schemas [table_name][stored_row [0] - 1]
+            return dict (zip (columns, stored_row [1:]))
+        return stored_row
+    def dump_row (self,table_name,row_data) :
+        return self.dumps (self.encode_row (table_name, row_data))
+    def load_row (self,table_name,db_row) :
+        return self.decode_row (table_name, self.loads (db_row))
+
+    ## Metadata rows, stored in the reserved META_TABLE
+    # Metadata is always json, it does not depend on the row codec
+    def read_meta (self,meta_name,default=None) :
+        meta_key = self.meta_key (meta_name)
+        if meta_key not in self.db :
+            return default
+        return json.loads (self.db [meta_key].decode ())
+    def write_meta (self,meta_name,meta_data) :
+        self.db [self.meta_key (meta_name)] = bytes (json.dumps (meta_data).encode ())
+
+    ## Table catalog, row count, stored row bytes and min/max key per table
+    # Kept in memory and updated by every row write and delete, commit saves
+    # it in the CATALOG_META row. load and older databases rebuild it.
+    def open_catalog (self) :
+        saved_catalog = self.read_meta (CATALOG_META)
+        if saved_catalog is None :
+            self.rebuild_catalog ()
+            self.commit ()
+            return
+        self.catalog = {}
+        for _, (table_name, stats) in enumerate (saved_catalog.items ()) :
+            self.catalog [table_name] = {
+                "rows" : stats ["rows"] ,
+                "bytes" : stats ["bytes"] ,
+                "min_key" : self.load_key (stats ["min_key"]) ,
+                "max_key" : self.load_key (stats ["max_key"])
+                }
+    def save_catalog (self) :
+        saved_catalog = {}
+        for _, (table_name, stats) in enumerate (self.catalog.items ()) :
+            saved_catalog [table_name] = {
+                "rows" : stats ["rows"] ,
+                "bytes" : stats ["bytes"] ,
+                "min_key" : self.dump_key (stats ["min_key"]) ,
+                "max_key" : self.dump_key (stats ["max_key"])
+                }
+        self.write_meta (CATALOG_META, saved_catalog)
+        self.catalog_changed = False
+    ## Scan all table rows and build the catalog
+    def rebuild_catalog (self) :
+        self.catalog = {}
+        for db_key, db_row in self.db.items () :
+            if not self.is_reserved_key (db_key) :
+                self.update_catalog (self.decode_key (db_key) [0], db_key, None, db_row)
+        self.catalog_changed = True
+    ## Update catalog after the row at db_key changed from old_db_row to
+    # new_db_row (stored rows), None is a missing row (insert or delete)
+    def update_catalog (self,table_name,db_key,old_db_row,new_db_row) :
+        stats = self.catalog.get (table_name)
+        if stats is None :
+            if old_db_row is not None or new_db_row is None :
+                return
+            stats = {"rows" : 0, "bytes" : 0, "min_key" : db_key, "max_key" : db_key}
+            self.catalog [table_name] = stats
+        if old_db_row is None :
+            stats ["rows"] += 1
+            if db_key < stats ["min_key"] :
+                stats ["min_key"] = db_key
+            if db_key > stats ["max_key"] :
+                stats ["max_key"] = db_key
+        else :
+            stats ["bytes"] -= len (old_db_row)
+        if new_db_row is None :
+            stats ["rows"] -= 1
+            if stats ["rows"] <= 0 :
+                del (self.catalog [table_name])
+            elif db_key == stats ["min_key"] or db_key == stats ["max_key"] :
+                stats ["min_key"], stats ["max_key"] = self.table_key_bounds (table_name)
+        else :
+            stats ["bytes"] += len (new_db_row)
+        self.catalog_changed = True
+    ## Returns number of rows in table
+    def count_rows (self,table_name) :
+        stats = self.catalog.get (table_name)
+        if stats is None :
+            return 0
+        return stats ["rows"]
+    ## Returns sorted list of table names, reserved tables are not listed
+    def list_tables (self) :
+        return sorted (self.catalog.keys ())
+    ## Returns table catalog entry, None if the table has no rows
+    def table_stats (self,table_name) :
+        stats = self.catalog.get (table_name)
+        if stats is None :
+            return None
+        return {
+            "table_name" : table_name ,
+            "rows" : stats ["rows"] ,
+            "bytes" : stats ["bytes"] ,
+            "min_key" : self.table_key (stats ["min_key"]) ,
+            "max_key" : self.table_key (stats ["max_key"])
+            }
+    ## Returns (first, last) btree keys in table
+    def table_key_bounds (self,table_name) :
+        key_low, key_high = self.prefix_range (table_name)
+        first_key = None
+        last_key = None
+        for db_key in self.db.keys (key_low, key_high) :
+            first_key = db_key
+            break
+        for db_key, _ in self.items_desc (key_high, key_low, True) :
+            last_key = db_key
+            break
+        return (first_key, last_key)
+    ## Generator, yields btree items from high_key down to key_low (included)
+    # btree DESC starts at the first key >= the start key, and returns nothing
+    # if there is no such key, then it is restarted from the last key.
+    def items_desc (self,high_key,key_low,exclude_high=False) :
+        found = False
+        for db_key, db_row in self.db.items (high_key, key_low, btree.DESC | btree.INCL) :
+            found = True
+            if db_key > high_key or (exclude_high and db_key == high_key) :
+                continue
+            yield (db_key, db_row)
+        if not found :
+            for db_key, db_row in self.db.items (None, key_low, btree.DESC | btree.INCL) :
+                yield (db_key, db_row)
+
+    ## Secondary indexes
+    # Index entries are stored in the reserved INDEX_TABLE:
+    #   __idx.<table_name>.<index_name>.<column value(s)>.<primary key(s)>
+    # Unique index entries do not include the primary key(s).
+    # The entry value is the btree key of the table row.
+    def index_name (self,columns) :
+        if not isinstance (columns, list) :
+            columns = [columns]
+        return INDEX_NAME_SEPARATOR.join ([str (column) for column in columns])
+    ## Returns {index entry key : unique} for each table_name index
+    def index_entries (self,table_name,db_key,row_data,table_indexes=None) :
+        entries = {}
+        if table_indexes is None :
+            table_indexes = self.indexes.get (table_name)
+        if row_data is None or not table_indexes :
+            return entries
+        pk = self.decode_key (db_key) [1:]
+        for _, (index_name, index_def) in enumerate (table_indexes.items ()) :
+            entry_key = [table_name, index_name]
+            try :
+                for _, column in enumerate (index_def ["columns"]) :
+                    entry_key.append (row_data [column])
+                if index_def ["unique"] :
+                    entries [self.build_key (INDEX_TABLE, entry_key)] = True
+                else :
+                    entries [self.build_key (INDEX_TABLE, entry_key + pk)] = False
+            except (KeyError, IndexError, TypeError) :
+                continue          # column missing, row is not indexed
+            except ValueError :
+                continue          # value is not a key type (tuple keys), row is not indexed
+        return entries
+    ## Replace old index entries with new entries for the row at db_key
+    # unique entries are tested before anything is changed
+    def update_index_entries (self,db_key,old_entries,new_entries) :
+        for _, (entry_key, unique) in enumerate (new_entries.items ()) :
+            if unique \
+            and entry_key not in old_entries \
+            and entry_key in self.db \
+            and self.db [entry_key] != db_key :
+                raise UniqueIndexError ("Duplicate unique index value: " + self.key_string (entry_key))
+        for entry_key in old_entries :
+            if entry_key not in new_entries :
+                del (self.db [entry_key])
+        for entry_key in new_entries :
+            if entry_key not in old_entries :
+                self.db [entry_key] = db_key
+    ## Returns btree low/high keys for index entries matching value
+    def index_key_range (self,table_name,index_name,value) :
+        index_key = [table_name, index_name]
+        if not isinstance (value, dict) :
+            if not isinstance (value, list) :
+                value = [value]
+            return self.prefix_range (INDEX_TABLE, index_key + value)  # exact value
+        key_low, key_high = self.prefix_range (INDEX_TABLE, index_key)
+        start_value = value.get ("start")
+        end_value = value.get ("end")
+        if start_value is not None :
+            if not isinstance (start_value, list) :
+                start_value = [start_value]
+            key_low = self.build_key (INDEX_TABLE, index_key + start_value)
+        if end_value is not None :
+            if not isinstance (end_value, list) :
+                end_value = [end_value]
+            key_high = self.prefix_range (INDEX_TABLE, index_key + end_value) [1]
+        return (key_low, key_high)
+    ## Returns list of (key, value) pairs from key_low up to key_high
+    # The btree iterator is reopened for each batch so the caller can update
+    # the btree between batches.
+    def read_key_batch (self,key_low,key_high,batch_size=100,after_key=None) :
+        batch = []
+        start_key = key_low
+        if after_key is not None :
+            start_key = after_key
+        for db_key, db_row in self.db.items (start_key, key_high) :
+            if db_key == after_key :
+                continue
+            batch.append ((db_key, db_row))
+            if len (batch) >= batch_size :
                 break
-        return rows
+        return batch
+    ## Delete all btree keys from key_low up to key_high
+    def delete_key_range (self,key_low,key_high) :
+        batch = self.read_key_batch (key_low, key_high)
+        while len (batch) > 0 :
+            for db_key, _ in batch :
+                del (self.db [db_key])
+            batch = self.read_key_batch (key_low, key_high)
+
+    ## Create index on column(s), existing rows are added to the index
+    def create_index (self,table_name,columns,unique=False) :
+        if not isinstance (columns, list) :
+            columns = [columns]
+        index_name = self.index_name (columns)
+        table_indexes = self.indexes.get (table_name, {})
+        if index_name in table_indexes :
+            return index_name                        # already exists
+        new_index = {index_name : {"columns" : columns, "unique" : unique}}
+        self.build_index (table_name, index_name, new_index)
+        table_indexes [index_name] = new_index [index_name]
+        self.indexes [table_name] = table_indexes
+        self.write_meta ("indexes", self.indexes)
+        self.commit_update ()
+        return index_name
+    ## Add index entries for all table_name rows
+    def build_index (self,table_name,index_name,new_index) :
+        entries_low, entries_high = self.index_key_range (table_name, index_name, {})
+        key_low, key_high = self.table_key_range (table_name)
+        batch = self.read_key_batch (key_low, key_high)
+        while len (batch) > 0 :
+            for db_key, db_row in batch :
+                entries = self.index_entries (table_name, db_key, self.load_row (table_name, db_row), new_index)
+                try :
+                    self.update_index_entries (db_key, {}, entries)
+                except ValueError :
+                    self.delete_key_range (entries_low, entries_high)
+                    raise
+            batch = self.read_key_batch (key_low, key_high, after_key=batch [-1][0])
+    ## Remove index and its entries
+    def drop_index (self,table_name,index) :
+        index_name = self.index_name (index)
+        table_indexes = self.indexes.get (table_name, {})
+        if index_name not in table_indexes :
+            return False
+        key_low, key_high = self.index_key_range (table_name, index_name, {})
+        self.delete_key_range (key_low, key_high)
+        del (table_indexes [index_name])
+        if len (table_indexes) == 0 :
+            del (self.indexes [table_name])
+        self.write_meta ("indexes", self.indexes)
+        self.commit_update ()
+        return True
+    ## Rebuild all index entries, used after load
+    def rebuild_indexes (self) :
+        self.indexes = self.read_meta ("indexes", {})
+        for _, (table_name, table_indexes) in enumerate (self.indexes.items ()) :
+            for _, (index_name, index_def) in enumerate (table_indexes.items ()) :
+                key_low, key_high = self.index_key_range (table_name, index_name, {})
+                self.delete_key_range (key_low, key_high)
+                self.build_index (table_name, index_name, {index_name : index_def})
+
+    ## Generator, yields table_name rows using index
+    # value is the indexed column value (list for multi column indexes)
+    # or {"start" : value, "end" : value} for a range of values
+    def iter_rows_by_index (self,table_name,index,value,limit=None,where=None,columns=None) :
+        yield from item_values (self.index_items (table_name, index, value, where, columns), limit)
+    ## Returns (index entry key, row) items for rows matching the index value
+    def index_items (self,table_name,index,value,where=None,columns=None,page_token=None) :
+        index_name = self.index_name (index)
+        table_indexes = self.indexes.get (table_name, {})
+        if index_name not in table_indexes :
+            raise KeyError ("No index: " + table_name + " " + index_name)
+        if table_indexes [index_name]["unique"] and not isinstance (value, dict) :
+            if not isinstance (value, list) :
+                value = [value]
+            entry_key = self.build_key (INDEX_TABLE, [table_name, index_name] + value)
+            items = []
+            if entry_key in self.db :
+                row = self.load_row (table_name, self.db [self.db [entry_key]])
+                if match_row (row, where) :
+                    if columns is not None :
+                        row = project_row (row, columns)
+                    items.append ((entry_key, row))
+            return items
+        key_low, key_high = self.index_key_range (table_name, index_name, value)
+        return self.iter_index_items (table_name ,
+                                        self.page_start (page_token, key_low) ,
+                                        key_high ,
+                                        where ,
+                                        columns)
+    ## Generator, yields (index entry key, row) from index entry key_low up to key_high
+    def iter_index_items (self,table_name,key_low,key_high,where=None,columns=None) :
+        for entry_key, db_key in self.db.items (key_low, key_high) :
+            row = self.load_row (table_name, self.db [db_key])
+            if where is not None and not match_row (row, where) :
+                continue
+            if columns is not None :
+                row = project_row (row, columns)
+            yield (entry_key, row)
+    ## Returns list of table_name rows using index
+    # With page_token ("" for the first page) returns a page, see read_page
+    def read_rows_by_index (self,table_name,index,value,limit=999999,where=None,columns=None,page_token=None) :
+        if page_token is None :
+            return list (self.iter_rows_by_index (table_name, index, value, limit, where, columns))
+        return read_page (self.index_items (table_name, index, value, where, columns, page_token), limit)
+
+    ## Returns list of keys in table
+    # With page_token ("" for the first page) returns a page, see read_page
+    def get_table_keys (self,table_name,start_key=None,end_key=None,limit=999999,page_token=None) :
+        if page_token is None :
+            return list (self.iter_table_keys (table_name, start_key, end_key, limit))
+        key_low, key_high = self.table_key_range (table_name, start_key, end_key)
+        return read_page (self.iter_key_items (self.page_start (page_token, key_low), key_high), limit)
+    ## Returns list of rows with keys starting with key_prefix
+    def scan_prefix (self,table_name,key_prefix,limit=999999,where=None,columns=None,page_token=None,raw=False) :
+        key_low, key_high = self.prefix_range (table_name, key_prefix)
+        items = self.iter_range_items (table_name ,
+                                        self.page_start (page_token, key_low) ,
+                                        key_high ,
+                                        where ,
+                                        columns ,
+                                        raw)
+        if page_token is None :
+            return list (item_values (items, limit))
+        return read_page (items, limit)
+    ## Returns the parent row with its child table rows nested in it
+    # child_specs is a list of child table names or dicts:
+    #   {"table" : child table, "name" : parent column (default table),
+    #    "limit" : n, "where" : predicate, "columns" : [column, ...]}
+    # Child rows have keys starting with the parent key (see scan_prefix),
+    # limit is the most rows returned for each child table.
+    # Returns None if the parent row is not found
+    def read_with_children (self,parent_table,key,child_specs,limit=999999) :
+        row = self.read_row (parent_table, key)
+        if row is None :
+            return None
+        if not isinstance (row, dict) :
+            raise ValueError ("Parent row must be a dict: " + parent_table)
+        for _, child_spec in enumerate (child_specs) :
+            if not isinstance (child_spec, dict) :
+                child_spec = {"table" : child_spec}
+            child_limit = child_spec.get ("limit")
+            if child_limit is None or child_limit > limit :
+                child_limit = limit
+            row [child_spec.get ("name", child_spec ["table"])] = self.scan_prefix (child_spec ["table"] ,
+                                                key ,
+                                                child_limit ,
+                                                child_spec.get ("where") ,
+                                                child_spec.get ("columns"))
+        return row
     ## Returns list of rows in a table
-    def get_table_items (self,table_name,start_key=None,end_key=None,limit=999999) :
-        items = []
-        key_low = start_key
-        key_high = end_key
-        if key_low is None :
-            key_low = self.key_low
-        if key_high is None :
-            key_high = self.key_high
-        #
-        for item in self.db.items (self.build_key (table_name, key_low) , # None) :
-                                      self.build_key (table_name, key_high)) :
-            items.append ([str (item[0].decode()), loads (item[1])])   # table row
-            if len (items) >= limit :
-                break
-        #print ("items:", items)
-        return items
+    def get_table_rows (self,table_name,start_key=None,end_key=None,limit=999999,where=None,columns=None,page_token=None,raw=False) :
+        key_low, key_high = self.table_key_range (table_name, start_key, end_key)
+        items = self.iter_range_items (table_name ,
+                                        self.page_start (page_token, key_low) ,
+                                        key_high ,
+                                        where ,
+                                        columns ,
+                                        raw)
+        if page_token is None :
+            return list (item_values (items, limit))
+        return read_page (items, limit)
+    ## Returns list of rows in a table
+    def get_table_items (self,table_name,start_key=None,end_key=None,limit=999999,where=None,columns=None,page_token=None) :
+        if page_token is None :
+            return list (self.iter_table_items (table_name, start_key, end_key, limit, where, columns))
+        key_low, key_high = self.table_key_range (table_name, start_key, end_key)
+        return read_page (self.iter_keyed_items (table_name ,
+                                                self.page_start (page_token, key_low) ,
+                                                key_high ,
+                                                where ,
+                                                columns) ,
+                            limit)
+
+    ## Aggregate table rows from start_key up to end_key, only totals are returned
+    # aggregations is a list of [function, column], see aggregate_specs
+    # group_by is a column or list of columns, where is a match_row predicate
+    def aggregate (self,table_name,start_key=None,end_key=None,aggregations=None,group_by=None,where=None) :
+        if aggregations is None :
+            aggregations = ["count"]
+        specs = aggregate_specs (aggregations)
+        if group_by is None :
+            totals = RowAggregate (specs)
+            for row in self.iter_table_rows (table_name, start_key, end_key, where=where) :
+                totals.add (row)
+            return totals.result ()
+        group_columns = group_by
+        if not isinstance (group_by, list) :
+            group_columns = [group_by]
+        groups = {}
+        group_order = []             # groups in the order first seen
+        for row in self.iter_table_rows (table_name, start_key, end_key, where=where) :
+            group = tuple ([row_value (row, column) for column in group_columns])
+            totals = groups.get (group)
+            if totals is None :
+                totals = RowAggregate (specs)
+                groups [group] = totals
+                group_order.append (group)
+            totals.add (row)
+        results = []
+        for _, group in enumerate (group_order) :
+            result = groups [group].result ()
+            if isinstance (group_by, list) :
+                result ["group"] = list (group)
+            else :
+                result ["group"] = group [0]
+            results.append (result)
+        return results
 
     ## dump_all
     def dump_all (self, file_path = None) :
         file_name = file_path
         if file_name is None :
             file_name = self.db_file_path + ".dump.txt"
+        index_prefix = self.prefix_range (INDEX_TABLE) [0]
+        file_keys = [self.meta_key (meta_name) for meta_name in FILE_META]
         with open (file_name, "w") as dump_file :
             for key in self.db :
+                if key.startswith (index_prefix) :
+                    continue      # index entries are rebuilt by load
+                if key in file_keys :
+                    continue      # codec/key encoding belong to the database file
                 row = self.db[key]
-                key = str (key.decode ())
                 ## Always dump row in json text format
-                if USE_JSON :
+                if self.codec == "json" or self.is_reserved_key (key) :
                     row = str (row.decode())
                 else :
-                    row = umsgpack.loads(row)
-                    row = json.dumps (row)
+                    row = json.dumps (self.loads (row))
+                key = self.dump_key (key)
                 #print (f"dump: {key}{self.dump_separator}{row}")
                 #print (f"{key}{self.dump_separator}{row}", file=dump_file)
                 dump_file.write (key + self.dump_separator + row + "\n")
     ## Build dump_all extract line (no database access)
     def dump_build_line (self,table_name,pk_id,row_data) :
-        key = self.build_key_from_ids (table_name, pk_id, row_data).decode ()
+        key = self.dump_key (self.build_key_from_ids (table_name, pk_id, row_data))
         return key + self.dump_separator + json.dumps (row_data) + "\n"
 
     ## load - Load DB from dump_all file format
     def load (self, file_path = None) :
+        return self.bulk_load (file_path)
+    ## bulk_load - Fast load of a dump_all file
+    # Commits every batch_size rows, verify=True checks each row is valid json
+    # Returns load counters: rows, seconds, rows_per_second (None if too fast to time)
+    def bulk_load (self, file_path = None, batch_size = BULK_LOAD_BATCH_SIZE, verify = False) :
         file_name = file_path
         if file_name is None :
             file_name = self.db_file_path + ".dump.txt"
         print ("Loading:", file_name)
+        if self.row_cache is not None :
+            self.row_cache.clear ()
+        start_ms = ticks_ms ()      # wraps after days, ticks_us after minutes
+        rows = 0
+        batch_rows = 0
+        file_keys = [self.meta_key (meta_name) for meta_name in FILE_META]
         with open (file_name, "r") as load_file :
-            for line in load_file:
-                key_row = (line.strip()).split (self.dump_separator)
-                #print ("key_row:",key_row)
-                key = bytes (key_row[0].encode ())
-                if USE_JSON :
-                    row = bytes (key_row[1].encode ())
+            for line in load_file :
+                line = line.rstrip ("\r\n")
+                if len (line) == 0 :
+                    continue
+                ## Only split on the first separator, row json may contain it
+                key_row = line.split (self.dump_separator, 1)
+                if len (key_row) < 2 :
+                    raise ValueError ("Bad dump line: " + line)
+                key = self.load_key (key_row[0])
+                if key in file_keys :
+                    continue
+                if self.codec == "json" or self.is_reserved_key (key) :
+                    if verify :
+                        json.loads (key_row[1])
+                    row = bytes (key_row[1].encode ())   # already json
                 else :
-                    row = json.loads (key_row[1])
-                    row = dumps (row)
-                print (f"load: key={key} row={row}")
+                    row = self.dumps (json.loads (key_row[1]))
+                #print (f"load: key={key} row={row}")
                 self.db [key] = row
+                rows += 1
+                batch_rows += 1
+                if batch_rows >= batch_size :
+                    self.pending_writes += batch_rows
+                    self.commit ()
+                    batch_rows = 0
+        self.pending_writes += batch_rows
+        self.load_schemas ()
+        self.rebuild_indexes ()
+        self.rebuild_catalog ()
+        self.commit ()
+        seconds = ticks_diff (ticks_ms (), start_ms) / 1000
+        rows_per_second = None
+        if seconds > 0 :
+            rows_per_second = int (rows / seconds)
+        print ("Loaded:", rows, "rows,", rows_per_second, "rows/second")
+        return {
+            "rows" : rows ,
+            "seconds" : seconds ,
+            "rows_per_second" : rows_per_second
+            }
+
+    ## Called after updates, commits according to commit_policy
+    def commit_update (self,writes=1) :
+        if self.pending_writes == 0 :
+            self.pending_start_ms = ticks_ms ()
+        self.pending_writes += writes
+        if self.commit_policy == COMMIT_AUTO :
+            self.commit ()
+        elif self.commit_policy == COMMIT_GROUP :
+            if self.pending_writes >= self.group_commit_writes :
                 self.commit ()
+            else :
+                self.commit_due ()
+    ## Group commit, commits pending writes older than group_commit_ms
+    # Call periodically so pending writes are not held while idle, the
+    # servers call it every group_commit_ms (SimpleDBServer.commit_interval_ms)
+    def commit_due (self) :
+        if self.pending_writes > 0 \
+        and ticks_diff (ticks_ms (), self.pending_start_ms) >= self.group_commit_ms :
+            self.commit ()
+            return True
+        return False
+    ## Update commit counters, pending writes are now committed
+    # Commits without pending row writes (metadata, empty commits) are not counted
+    def count_commit (self) :
+        if self.pending_writes == 0 :
+            return
+        self.commit_stats ["commits"] += 1
+        self.commit_stats ["writes"] += self.pending_writes
+        self.commit_stats ["last_commit_writes"] = self.pending_writes
+        if self.pending_writes > self.commit_stats ["max_commit_writes"] :
+            self.commit_stats ["max_commit_writes"] = self.pending_writes
+        self.pending_writes = 0
+    ## Returns commit counters, writes = rows written by all commits
+    def get_commit_stats (self) :
+        commit_stats = dict (self.commit_stats)
+        commit_stats ["pending_writes"] = self.pending_writes
+        return commit_stats
 
     ## commit updates(s), if autocommit is not set
     def commit (self) :
+        if self.catalog_changed :
+            self.save_catalog ()
         self.db.flush ()
+        self.count_commit ()
     def close (self) :
         self.commit ()
         self.db.close ()
@@ -339,6 +1179,79 @@ class SimpleDB :
 
 # end SimpleDB  #
 
+## SimpleDBCursor - Walks a table key range
+#
+# Notes:
+#   o Rows are returned in key order, reverse=True returns them high to low
+#   o Each row value is decoded once, no second lookup by key
+#   o key is the table key of the last row fetched
+#   o Range is start_key up to, but not including, end_key in either direction
+#   o The btree module has one iteration state per database, each fetch
+#     starts a new range after the last key fetched so other reads between
+#     fetches do not move the cursor
+#
+class SimpleDBCursor :
+    def __init__ (self,simple_db,table_name,start_key=None,end_key=None,reverse=False) :
+        self.simple_db = simple_db
+        self.table_name = table_name
+        self.reverse = reverse
+        self.key_low, self.key_high = simple_db.table_key_range (table_name,
+                                                                  start_key,
+                                                                  end_key)
+        self.key = None
+        self.seek ()
+
+    ## Position cursor at key (or next key in cursor direction)
+    # key = None positions the cursor at the start of the range
+    def seek (self,key=None) :
+        self.key = None
+        self.done = False
+        seek_key = None
+        if key is not None :
+            seek_key = self.simple_db.build_key (self.table_name, key)
+        self.skip_key = False            # include seek key
+        if not self.reverse :
+            if seek_key is None or seek_key < self.key_low :
+                seek_key = self.key_low
+        else :
+            if seek_key is None or seek_key >= self.key_high :
+                seek_key = self.key_high
+                self.skip_key = True     # exclude key_high
+        self.seek_key = seek_key         # btree key the next fetch starts at
+
+    ## Returns next row, None at end of range
+    def fetch_one (self) :
+        rows = self.fetch_many (1)
+        if len (rows) == 0 :
+            return None
+        return rows [0]
+    ## Returns list of up to count rows
+    def fetch_many (self,count) :
+        rows = []
+        if self.done or count <= 0 :
+            return rows
+        if not self.reverse :
+            items = self.simple_db.db.items (self.seek_key, self.key_high)
+        else :
+            items = self.simple_db.items_desc (self.seek_key, self.key_low, self.skip_key)
+        for db_key, db_row in items :
+            if self.skip_key and db_key == self.seek_key :
+                continue                 # fetched last time
+            rows.append (self.simple_db.load_row (self.table_name, db_row))
+            self.seek_key = db_key
+            self.skip_key = True
+            if len (rows) >= count :
+                break
+        if len (rows) < count :
+            self.done = True             # end of range
+        if len (rows) > 0 :
+            self.key = self.simple_db.table_key (self.seek_key)   # table key only
+        return rows
+    def close (self) :
+        self.done = True
+
+# end SimpleDBCursor  #
+
 def main () :
     import os
     #print (os.uname())
@@ -419,6 +1332,31 @@ def main () :
     print ("bad read:", my_db.read_row ("customer", "000199")) # bad key
     print ("all keys:", my_db.get_table_keys ("customer"))
     print ("rows:", my_db.get_table_rows ("customer", "000500", "990000"))
+    print ("write_rows:", my_db.write_rows ("temp", "id", [{"id" : "03"} ,
+                                                        {"id" : "01"} ,
+                                                        {"id" : "02"}]))
+    print ("delete_rows:", my_db.delete_rows ("temp", ["01", "02", "03", "04"]))
+    customers = my_db.cursor ("customer", reverse=True)
+    print ("cursor rows:", customers.fetch_many (2))
+    customers.seek ("000500")
+    print ("cursor seek:", customers.fetch_one ())
+    customers.seek ()
+    print ("cursor first:", customers.fetch_one ())
+    my_db.get_table_keys ("customer")        # other reads between fetches
+    print ("cursor next:", customers.fetch_one ())
+    print ("tables:", my_db.list_tables ())
+    print ("customer rows:", my_db.count_rows ("customer"))
+    print ("customer stats:", my_db.table_stats ("customer"))
+    print ("scan_prefix:", my_db.scan_prefix ("invoice_line", "090001", columns=["sku"]))
+    print ("read_with_children:", my_db.read_with_children ("invoice", "090001" ,
+                                        [{"table" : "invoice_line", "name" : "lines"}]))
+    print ("page:", my_db.get_table_keys ("customer", limit=2, page_token=""))
+    print ("where:", my_db.get_table_rows ("customer" ,
+                                        where={"eq" : ["occupation", "Three stooges"]} ,
+                                        columns=["name"]))
+    print ("aggregate:", my_db.aggregate ("invoice_line", aggregations=["count", ["sum", "price"]]))
+    for row in my_db.iter_table_rows ("invoice_line") :
+        print ("iter row:", row)
     if my_db.row_exists ("customer", "999999") :
         print ("Delete row:", my_db.delete_row ("customer", "999999"))
         if my_db.row_exists ("customer", "999999") :
@@ -0,0 +1,369 @@
+#
+################################################################################
+# The MIT License (MIT)
+#
+# Copyright (c) 2025 Curt Timmerman
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+################################################################################
+#
+## AsyncSimpleDBClient - asyncio version of SimpleDBClient
+#
+# Notes:
+#   o Database methods are the SimpleDBClient methods, they return
+#     coroutines: row = await my_db.read_row ("customer", "000100")
+#   o Calls made while requests are in flight are queued and sent together
+#     as one json rpc batch, replies are matched to calls by "id"
+#   o Up to pool_size batches are in flight at once, each on its own
+#     connection, idle connections are reused if the server keeps them
+#     open (simple_db_microdot.py closes every connection)
+#   o get_date_time,get_date,get_time with use_local_date_time=True are
+#     not coroutines, they do not call the server
+#   o batch () is not needed, concurrent calls are batched automatically
+#   o iter_table_rows etc. and stream_table_rows etc. are async generators:
+#       async for row in my_db.iter_table_rows ("customer") :
+#   o Uses asyncio streams only, no HTTP client module is needed
+#
+################################################################################
+
+import asyncio
+import json
+
+from simple_db_client import SimpleDBClient, POOL_SIZE, REQUEST_TIMEOUT, ticks_ms, ticks_diff, \
+                                JSON_CONTENT_TYPE, check_page_reply, \
+                                WRITE_METHODS
+
+## Most calls sent in one batch, see simple_db_server BATCH_MAX_REQUESTS
+BATCH_MAX_CALLS = 100
+
+## AsyncCall - Queued call, reply is set before done is set
+class AsyncCall :
+    def __init__ (self, rpc_dict) :
+        self.rpc_dict = rpc_dict
+        self.done = asyncio.Event ()
+        self.reply = None
+
+class AsyncSimpleDBClient (SimpleDBClient) :
+    def __init__ (self,
+                    hostname = "localhost",
+                    port = 8080,
+                    use_local_date_time = True,
+                    pool_size = POOL_SIZE,
+                    timeout = REQUEST_TIMEOUT,
+                    batch_max = BATCH_MAX_CALLS,
+                    use_msgpack = True) :
+        SimpleDBClient.__init__ (self, hostname, port, use_local_date_time,
+                                    pool_size, timeout, use_msgpack)
+        self.batch_max = batch_max
+        self.pending = []        # AsyncCalls waiting to be sent
+        self.senders = 0         # batches in flight
+        self.request_stats ["calls"] = 0
+
+    ## Connections are asyncio streams, kept open if the server supports keep-alive
+    def open_session (self) :
+        self.idle = []           # keep-alive (reader, writer) connections
+
+    ## Get server configuration
+    async def get_configuration (self) :
+        server_config = await self.send_rpc_request ("get_configuration", {})
+        if server_config is None :
+            return False
+        if "key_separator" in server_config :
+            self.key_separator = server_config ["key_separator"]
+        if "dump_separator" in server_config :
+            self.dump_separator = server_config ["dump_separator"]
+        if "simpledb_available" in server_config :
+            return server_config ["simpledb_available"]
+        return True         # Assume the best
+
+    def batch (self) :
+        raise RuntimeError ("AsyncSimpleDBClient batches concurrent calls automatically")
+    ## Reads are not cached
+    async def send_cached_request (self, method, params) :
+        return await self.send_rpc_request (method, params)
+
+    ## Close keep-alive connections
+    async def close (self) :
+        while len (self.idle) > 0 :
+            _, writer = self.idle.pop ()
+            await self.close_connection (writer)
+
+    ## Async generator, yields results of a paged method page by page
+    # The next page is requested while the current page is being used
+    # Raises RuntimeError if a page request fails
+    async def iter_pages (self, method, request_dict) :
+        next_reply = None
+        try :
+            reply = await self.send_rpc_reply (method, dict (request_dict, page_token = ""))
+            while True :
+                check_page_reply (method, reply)
+                next_token = reply.get ("next_token")
+                next_reply = None
+                if next_token is not None :
+                    next_reply = asyncio.create_task (
+                        self.send_rpc_reply (method, dict (request_dict, page_token = next_token)))
+                for _, result in enumerate (reply ["result"]) :
+                    yield result
+                if next_reply is None :
+                    return
+                reply = await next_reply
+        finally :
+            if next_reply is not None and not next_reply.done () :
+                next_reply.cancel ()
+
+    ## Async generator, posts a stream request and yields rows as they arrive
+    # Each stream has its own connection, the server closes it at the end.
+    # Raises RuntimeError after the last row if the stream failed or was cut off
+    async def iter_stream (self, method, params) :
+        self.id += 1
+        body = json.dumps ({
+            "jsonrpc" : "2.0" ,
+            "method" : method ,
+            "params" : params ,
+            "id" : str (self.id)
+            }).encode ()
+        writer = None
+        last_line = None
+        start_ms = ticks_ms ()
+        try :
+            reader, writer = await asyncio.wait_for (asyncio.open_connection (self.hostname, self.port) ,
+                                                    self.timeout)
+            self.request_stats ["connections"] += 1
+            writer.write (self.post_header ("/stream", body, {"Content-Type" : JSON_CONTENT_TYPE}) + body)
+            await writer.drain ()
+            _, content_length, _ = await asyncio.wait_for (self.read_header (reader), self.timeout)
+            while content_length is None or content_length > 0 :
+                line = await asyncio.wait_for (reader.readline (), self.timeout)
+                if len (line) == 0 :
+                    break
+                if content_length is not None :
+                    content_length -= len (line)
+                line = line.strip ()
+                if len (line) == 0 :
+                    continue
+                if last_line is not None :
+                    yield json.loads (last_line)   # not the last line
+                last_line = line
+        except Exception :
+            self.request_stats ["errors"] += 1
+            raise
+        finally :
+            request_ms = ticks_diff (ticks_ms (), start_ms)
+            self.request_stats ["requests"] += 1
+            self.request_stats ["total_ms"] += request_ms
+            self.request_stats ["last_ms"] = request_ms
+            if request_ms > self.request_stats ["max_ms"] :
+                self.request_stats ["max_ms"] = request_ms
+            if writer is not None :
+                await self.close_connection (writer)
+        reply = None
+        if last_line is not None :
+            reply = json.loads (last_line)
+        if not isinstance (reply, dict) or "result" not in reply :
+            self.request_stats ["errors"] += 1
+            if isinstance (reply, dict) and "error" in reply :
+                raise RuntimeError (method + " stream failed: " + str (reply ["error"]))
+            raise RuntimeError (method + " stream cut off")
+
+    ## Queue call, returns the call result, None on error
+    async def send_rpc_request (self, method, params) :
+        reply = await self.send_rpc_reply (method, params)
+        if reply is not None :
+            if "result" in reply :
+                return reply ["result"]
+            elif "error" in reply :
+                pass   # Do something here?
+        return None
+    ## Queue call, returns the whole reply dict, None on error
+    async def send_rpc_reply (self, method, params) :
+        self.id += 1
+        call = AsyncCall ({
+            "jsonrpc" : "2.0" ,
+            "method" : method ,
+            "params" : params ,
+            "id" : str (self.id)
+            })
+        self.pending.append (call)
+        self.request_stats ["calls"] += 1
+        if self.senders < self.pool_size :
+            self.senders += 1
+            asyncio.create_task (self.sender ())
+        await call.done.wait ()
+        return call.reply
+
+    ## Task, sends queued calls until the queue is empty
+    async def sender (self) :
+        try :
+            while len (self.pending) > 0 :
+                calls = self.pending [:self.batch_max]
+                self.pending = self.pending [self.batch_max:]
+                if len (calls) == 1 :
+                    replies = await self.send_request (calls [0].rpc_dict)
+                else :
+                    replies = await self.send_request ([call.rpc_dict for call in calls])
+                if isinstance (replies, dict) :
+                    replies = [replies]
+                reply_ids = {}
+                if isinstance (replies, list) :
+                    for _, reply in enumerate (replies) :
+                        if isinstance (reply, dict) and "id" in reply :
+                            reply_ids [reply ["id"]] = reply
+                for _, call in enumerate (calls) :
+                    call.reply = reply_ids.get (call.rpc_dict ["id"])
+                    call.done.set ()
+        finally :
+            self.senders -= 1
+
+    ## Sends json rpc request (dict or batch list) to the server
+    # The RPC reply is returned as a dict (list for a batch) or None on error
+    async def send_request (self, rpc_data) :
+        start_ms = ticks_ms ()
+        try :
+            return await asyncio.wait_for (self.post (self.encode_request (rpc_data),
+                                                        self.read_only (rpc_data)) ,
+                                            self.timeout)
+        except Exception as e :
+            print ("AsyncSimpleDBClient.post:", repr (e))
+            self.request_stats ["errors"] += 1
+        finally :
+            request_ms = ticks_diff (ticks_ms (), start_ms)
+            self.request_stats ["requests"] += 1
+            self.request_stats ["total_ms"] += request_ms
+            self.request_stats ["last_ms"] = request_ms
+            if request_ms > self.request_stats ["max_ms"] :
+                self.request_stats ["max_ms"] = request_ms
+        return None
+
+    ## True if no call in rpc_data (dict or batch list) changes the database
+    def read_only (self, rpc_data) :
+        if isinstance (rpc_data, dict) :
+            rpc_data = [rpc_data]
+        for _, rpc_dict in enumerate (rpc_data) :
+            if rpc_dict.get ("method") in WRITE_METHODS :
+                return False
+        return True
+
+    ## HTTP POST, reuses an idle connection if there is one, returns the decoded reply
+    # A reused connection the server already closed is retried on a new
+    # connection only if no response bytes arrived and read_only is True,
+    # the server may have run the calls before it closed the connection
+    async def post (self, body, read_only = False) :
+        request = self.post_header ("/", body, self.post_headers) + body
+        while True :
+            reused = len (self.idle) > 0
+            if reused :
+                reader, writer = self.idle.pop ()
+            else :
+                reader, writer = await asyncio.open_connection (self.hostname, self.port)
+                self.request_stats ["connections"] += 1
+            try :
+                writer.write (request)
+                await writer.drain ()
+                keep_alive, reply_body, content_type = await self.read_response (reader)
+            except asyncio.IncompleteReadError :
+                await self.close_connection (writer)      # part of the response arrived
+                raise
+            except EOFError :
+                await self.close_connection (writer)
+                if reused and read_only :
+                    continue       # server closed the idle connection, retry
+                raise
+            except BaseException :
+                await self.close_connection (writer)
+                raise
+            if keep_alive :
+                self.idle.append ((reader, writer))
+            else :
+                await self.close_connection (writer)
+            return self.decode_reply (reply_body, content_type)
+
+    ## Returns the HTTP/1.1 POST request header for body
+    def post_header (self, path, body, headers) :
+        header = ("POST " + path + " HTTP/1.1\r\n"
+                    + "Host: " + self.hostname + ":" + str (self.port) + "\r\n")
+        for _, (name, value) in enumerate (headers.items ()) :
+            header += name + ": " + value + "\r\n"
+        return (header
+                + "Content-Length: " + str (len (body)) + "\r\n"
+                + "\r\n").encode ()
+
+    ## Returns (keep_alive, body, content_type) from an HTTP response
+    # raises EOFError if the connection was closed before the response
+    async def read_response (self, reader) :
+        keep_alive, content_length, content_type = await self.read_header (reader)
+        if content_length is None :
+            return (False, await reader.read (-1), content_type)     # body ends at close
+        return (keep_alive, await reader.readexactly (content_length), content_type)
+
+    ## Returns (keep_alive, content_length, content_type) from an HTTP response header
+    # content_length is None if the body ends when the connection closes
+    async def read_header (self, reader) :
+        status_line = await reader.readline ()
+        if len (status_line) == 0 :
+            raise EOFError ("Connection closed")
+        status = status_line.split ()
+        keep_alive = status [0] == b"HTTP/1.1"
+        content_length = None
+        content_type = None
+        while True :
+            line = await reader.readline ()
+            if line in (b"\r\n", b"\n", b"") :
+                break
+            name, _, value = line.decode ().partition (":")
+            name = name.strip ().lower ()
+            value = value.strip ().lower ()
+            if name == "content-length" :
+                content_length = int (value)
+            elif name == "content-type" :
+                content_type = value
+            elif name == "connection" :
+                keep_alive = value == "keep-alive" or (keep_alive and value != "close")
+        return (keep_alive, content_length, content_type)
+
+    async def close_connection (self, writer) :
+        try :
+            writer.close ()
+            await writer.wait_closed ()
+        except Exception :
+            pass
+
+# end AsyncSimpleDBClient  #
+
+async def async_main () :
+    my_db = AsyncSimpleDBClient ("127.0.0.1", 8080)
+    print (await my_db.get_configuration ())
+    await my_db.write_rows ("async_test", "id", [{"id" : "%04d" % number, "value" : number}
+                                                    for number in range (100)])
+    start_ms = ticks_ms ()
+    rows = await asyncio.gather (*[my_db.read_row ("async_test", "%04d" % (number % 100))
+                                    for number in range (1000)])
+    print ("reads:", len (rows), "ms:", ticks_diff (ticks_ms (), start_ms))
+    print ("sum:", sum ([row ["value"] for row in rows]))
+    print ("iter rows:", len ([row async for row in my_db.iter_table_rows ("async_test", limit=30)]))
+    print ("stream rows:", len ([row async for row in my_db.stream_table_rows ("async_test")]))
+    print ("request stats:", my_db.get_request_stats ())
+    print ("delete_rows:", await my_db.delete_rows ("async_test", ["%04d" % number for number in range (100)]))
+    await my_db.close ()
+
+def main () :
+    asyncio.run (async_main ())
+
+#----------------------------------------------------
+if __name__ == "__main__" :
+    main ()
@@ -28,51 +28,247 @@
 # Notes:
 #   o get_date_time,get_date,get_time functions return local time, not the
 #     server local time.
+#   o batch () sends many calls in one request:
+#       with my_db.batch () as batch :
+#           row = batch.read_row ("customer", "000100")
+#           keys = batch.get_table_keys ("customer")
+#       print (row.result (), keys.result ())
+#   o iter_table_rows etc. read every row, page by page, the server limits
+#     the rows in each reply (limit_max) and returns a next_token for more.
+#     The next page is requested while the current page is being used.
+#   o Requests and replies are msgpack if umsgpack is installed on both the
+#     client and the server (use_msgpack=False for json only). The client
+#     accepts msgpack replies and sends msgpack once the server replies in it.
+#   o stream_table_rows etc. read every row with one request to /stream,
+#     rows are decoded as they arrive, memory use does not grow with the
+#     number of rows
+#   o cache_rows > 0 keeps read_row and read_columns results. A cached
+#     result is used without asking the server for cache_ttl seconds, then
+#     it is revalidated with its table generation (one small reply if the
+#     table is unchanged). Do not change rows returned from the cache.
 #
 ################################################################################
 
 import time
 
-import requests
 import json
 
-## This function determines how the json RPC request is sent
-# The RPC reply is returned as a dict or None on error
-# This code should be in a module
-REQUEST_URL = None
-def send_request (rpc_dict) :
-    response = None
-    try :
-        response = requests.post (REQUEST_URL ,
-                                    json = rpc_dict ,
-                                    headers = {'Content-Type': 'application/json'})
-        #print ("send_rpc: reply:",response.json())
-        return response.json ()
-    except Exception as e :
-        print ("requests.post:", e)
-    finally :
-        if response is not None :
-            response.close ()
-    ## report error here
-    return None
+## HTTP client, not needed by SimpleDBSocketClient
+try :
+    import requests
+except ImportError :
+    requests = None
+
+## msgpack wire format is optional
+try :
+    import umsgpack
+except ImportError :
+    umsgpack = None
+
+## Wire formats (HTTP Content-Type)
+JSON_CONTENT_TYPE = "application/json"
+MSGPACK_CONTENT_TYPE = "application/msgpack"
+
+## Page prefetch thread, not available with MicroPython
+try :
+    from concurrent.futures import ThreadPoolExecutor
+    from threading import Lock
+except ImportError :
+    ThreadPoolExecutor = None
+
+## Connection defaults
+POOL_SIZE = 4           # connections kept by each client if the server supports keep-alive
+REQUEST_TIMEOUT = 10    # seconds, connect and read
+
+## Read cache defaults, cache_rows=0 is no cache
+CACHE_TTL = 0           # seconds a cached read is used before it is revalidated
+
+## Methods that change the database, see simple_db_server WRITE_METHODS
+# A request with one is not resent, cached reads of their table (all
+# tables without table_name) are dropped
+WRITE_METHODS = (
+    "write_row" ,
+    "write_rows" ,
+    "rewrite_row" ,
+    "delete_row" ,
+    "delete_rows" ,
+    "create_index" ,
+    "drop_index" ,
+    "set_schema" ,
+    "commit" ,
+    "commit_due" ,
+    "load" ,
+    "bulk_load" ,
+    "recode"
+    )
+
+## millisecond timer, time.ticks_ms is MicroPython only
+try :
+    ticks_ms = time.ticks_ms
+    ticks_diff = time.ticks_diff
+except AttributeError :
+    ticks_ms = lambda : int (time.monotonic () * 1000)
+    ticks_diff = lambda end_ms, start_ms : end_ms - start_ms
+
+## NoLock - Used when there is no prefetch thread
+class NoLock :
+    def acquire (self) :
+        return True
+    def release (self) :
+        pass
+## Returns the lock of request ids, request_stats, the session and the wire format
+def allocate_request_lock () :
+    if ThreadPoolExecutor is None :
+        return NoLock ()
+    return Lock ()
+
+## Raises RuntimeError if a page reply is missing or an error
+def check_page_reply (method, reply) :
+    if isinstance (reply, dict) and "result" in reply :
+        return
+    if isinstance (reply, dict) and "error" in reply :
+        raise RuntimeError (method + " page failed: " + str (reply ["error"]))
+    raise RuntimeError (method + " page failed: no reply")
+
+## Returns a urllib3 connection pool class that counts new connections in
+# request_stats, the server may close a keep-alive connection at any time
+def counting_pool_class (request_stats) :
+    import urllib3
+    class CountingConnection (urllib3.connection.HTTPConnection) :
+        def connect (self) :
+            request_stats ["connections"] += 1
+            super ().connect ()
+    class CountingPool (urllib3.HTTPConnectionPool) :
+        ConnectionCls = CountingConnection
+    return CountingPool
 
 DATE_FORMAT = "{:04d}-{:02d}-{:02d}"
 TIME_FORMAT = "{:02d}:{:02d}:{:02d}"
 
+## ReadCache - Client cache of read results, at most max_rows results
+# Slots are [cache key, table name, generation, result, fetched ms, referenced]
+# Evicts with a clock hand, referenced results get a second chance
+class ReadCache :
+    def __init__ (self,max_rows) :
+        self.max_rows = max_rows
+        self.slot_index = {}     # cache key : slot number
+        self.slots = []
+        self.free_slots = []
+        self.hand = 0
+        self.hits = 0            # used without a request (cache_ttl)
+        self.revalidated = 0     # server replied not_modified
+        self.misses = 0
+        self.evictions = 0
+
+    ## Returns the cache slot, None if not cached
+    def get (self,cache_key) :
+        slot_number = self.slot_index.get (cache_key)
+        if slot_number is None :
+            return None
+        slot = self.slots [slot_number]
+        slot [5] = True
+        return slot
+    ## Add or replace a result
+    def put (self,cache_key,table_name,generation,result) :
+        self.invalidate (cache_key)
+        slot = [cache_key, table_name, generation, result, ticks_ms (), False]
+        if len (self.free_slots) > 0 :
+            slot_number = self.free_slots.pop ()
+            self.slots [slot_number] = slot
+        else :
+            slot_number = len (self.slots)
+            self.slots.append (slot)
+        self.slot_index [cache_key] = slot_number
+        self.evict (cache_key)
+    ## Remove a result from the cache
+    def invalidate (self,cache_key) :
+        slot_number = self.slot_index.pop (cache_key, None)
+        if slot_number is not None :
+            self.slots [slot_number] = None
+            self.free_slots.append (slot_number)
+    ## Remove the results of table_name, every result if None
+    def invalidate_table (self,table_name=None) :
+        for _, slot in enumerate (self.slots) :
+            if slot is not None and (table_name is None or slot [1] == table_name) :
+                self.invalidate (slot [0])
+    ## Evict results until the cache is within max_rows, keep_key is not evicted
+    def evict (self,keep_key) :
+        while len (self.slot_index) > self.max_rows :
+            if self.hand >= len (self.slots) :
+                self.hand = 0
+            slot = self.slots [self.hand]
+            if slot is not None and slot [0] != keep_key :
+                if slot [5] :
+                    slot [5] = False         # second chance
+                else :
+                    self.invalidate (slot [0])
+                    self.evictions += 1
+            self.hand += 1
+    def get_stats (self) :
+        reads = self.hits + self.revalidated + self.misses
+        hit_rate = 0
+        if reads > 0 :
+            hit_rate = (self.hits + self.revalidated) / reads
+        return {
+            "rows" : len (self.slot_index) ,
+            "max_rows" : self.max_rows ,
+            "hits" : self.hits ,
+            "revalidated" : self.revalidated ,
+            "misses" : self.misses ,
+            "evictions" : self.evictions ,
+            "hit_rate" : hit_rate
+            }
+
 class SimpleDBClient :
     def __init__ (self,
                     hostname = "localhost",
                     port = 8080,
-                    use_local_date_time = True) :
-        global REQUEST_URL
+                    use_local_date_time = True,
+                    pool_size = POOL_SIZE,
+                    timeout = REQUEST_TIMEOUT,
+                    use_msgpack = True,
+                    cache_rows = 0,
+                    cache_ttl = CACHE_TTL) :
         if not use_local_date_time :
             self.get_date_time = self.get_date_time_server
             self.get_date = self.get_date_server
             self.get_time = self.get_time_server
         self.id = 0
+        self.request_lock = allocate_request_lock ()     # the prefetch thread sends requests too
+        self.open_read_cache (cache_rows, cache_ttl)
+        self.hostname = hostname
+        self.port = port
         self.url = "http://" + hostname + ":" + str (port)
-        REQUEST_URL = self.url
-        self.post_headers = {'Content-Type': 'application/json'}
+        self.wire = JSON_CONTENT_TYPE      # request format until the server replies in msgpack
+        self.post_headers = {'Content-Type': JSON_CONTENT_TYPE}
+        if use_msgpack and umsgpack is not None :
+            self.post_headers ["Accept"] = MSGPACK_CONTENT_TYPE + ", " + JSON_CONTENT_TYPE
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.request_stats = {
+            "requests" : 0 ,
+            "errors" : 0 ,
+            "connections" : 0 ,
+            "total_ms" : 0 ,
+            "last_ms" : 0 ,
+            "max_ms" : 0
+            }
+        self.session = None
+        self.open_session ()
+
+    ## Connection pool, kept open if the server supports keep-alive
+    # MicroPython requests has no Session and opens a new connection for
+    # every request, subclasses with their own connections override this
+    def open_session (self) :
+        if hasattr (requests, "Session") :
+            adapter = requests.adapters.HTTPAdapter (pool_connections = 1 ,
+                                                    pool_maxsize = self.pool_size)
+            adapter.poolmanager.pool_classes_by_scheme = {
+                "http" : counting_pool_class (self.request_stats)
+                }
+            self.session = requests.Session ()
+            self.session.mount ("http://", adapter)
+            self.session.headers.update (self.post_headers)
 
     ## Get server configuration
     def get_configuration (self) :
@@ -97,6 +293,14 @@ class SimpleDBClient :
             "row_data" : row_data
             }
         return self.send_rpc_request ("write_row", request_dict)
+    ## writes many table rows, one request and one server commit
+    def write_rows (self,table_name,pk_id,rows) :
+        request_dict = {
+            "table_name" : table_name ,
+            "pk_id" : pk_id ,
+            "rows" : rows
+            }
+        return self.send_rpc_request ("write_rows", request_dict)
     ## rewrites updated table row from update_data
     def rewrite_row (self,table_name,key,update_data) :
         #print ("w_r:", table_name,pk)
@@ -113,7 +317,7 @@ class SimpleDBClient :
             "table_name" : table_name ,
             "key" : key
             }
-        return self.send_rpc_request ("read_row", request_dict)
+        return self.send_cached_request ("read_row", request_dict)
     ## read row column from table/key, returns None if not found
     def read_columns (self,table_name,key,column_list) :
         request_dict = {
@@ -121,7 +325,7 @@ class SimpleDBClient :
             "key" : key ,
             "column_list" : column_list
             }
-        return self.send_rpc_request ("read_columns", request_dict)
+        return self.send_cached_request ("read_columns", request_dict)
 
     ## read next table indexed row, or first row if key is not provided
     def first_row (self,table_name,key = "") :
@@ -155,6 +359,13 @@ class SimpleDBClient :
             "key" : key
             }
         return self.send_rpc_request ("delete_row", request_dict)
+    ## Delete many rows from table, one request and one server commit
+    def delete_rows (self,table_name,keys) :
+        request_dict = {
+            "table_name" : table_name ,
+            "keys" : keys
+            }
+        return self.send_rpc_request ("delete_rows", request_dict)
     ## Returns list of keys in table
     # Not too useful except for testing
     def get_table_keys (self,table_name,start_key=None,end_key=None,limit=999999) :
@@ -167,25 +378,331 @@ class SimpleDBClient :
         return self.send_rpc_request ("get_table_keys", request_dict)
 
     ## Returns list of rows in a table
-    def get_table_rows (self,table_name,start_key=None,end_key=None,limit=999999) :
+    def get_table_rows (self,table_name,start_key=None,end_key=None,limit=999999,where=None,columns=None) :
         request_dict = {
             "table_name" : table_name ,
             "start_key" : start_key ,
             "end_key" : end_key ,
-            "limit" : limit
+            "limit" : limit ,
+            "where" : where ,
+            "columns" : columns
             }
         return self.send_rpc_request ("get_table_rows", request_dict)
 
+    ## Returns list of rows with keys starting with key_prefix
+    def scan_prefix (self,table_name,key_prefix,limit=999999,where=None,columns=None) :
+        request_dict = {
+            "table_name" : table_name ,
+            "key_prefix" : key_prefix ,
+            "limit" : limit ,
+            "where" : where ,
+            "columns" : columns
+            }
+        return self.send_rpc_request ("scan_prefix", request_dict)
+
+    ## Returns parent row with child table rows nested in it, one request
+    def read_with_children (self,parent_table,key,child_specs,limit=999999) :
+        request_dict = {
+            "parent_table" : parent_table ,
+            "key" : key ,
+            "child_specs" : child_specs ,
+            "limit" : limit
+            }
+        return self.send_rpc_request ("read_with_children", request_dict)
+
     ## Returns list of keys/rows from a table
-    def get_table_items (self,table_name,start_key=None,end_key=None,limit=999999) :
+    def get_table_items (self,table_name,start_key=None,end_key=None,limit=999999,where=None,columns=None) :
         request_dict = {
             "table_name" : table_name ,
             "start_key" : start_key ,
             "end_key" : end_key ,
-            "limit" : limit
+            "limit" : limit ,
+            "where" : where ,
+            "columns" : columns
             }
         return self.send_rpc_request ("get_table_items", request_dict)
 
+    ## Returns table totals computed by the server, rows are not transferred
+    def aggregate (self,table_name,start_key=None,end_key=None,aggregations=None,group_by=None,where=None) :
+        request_dict = {
+            "table_name" : table_name ,
+            "start_key" : start_key ,
+            "end_key" : end_key ,
+            "aggregations" : aggregations ,
+            "group_by" : group_by ,
+            "where" : where
+            }
+        return self.send_rpc_request ("aggregate", request_dict)
+
+    ## Add a table schema version, dict rows are stored as value arrays
+    def set_schema (self,table_name,columns) :
+        request_dict = {
+            "table_name" : table_name ,
+            "columns" : columns
+            }
+        return self.send_rpc_request ("set_schema", request_dict)
+    ## Returns list of table schema versions
+    def get_schema (self,table_name) :
+        request_dict = {
+            "table_name" : table_name
+            }
+        return self.send_rpc_request ("get_schema", request_dict)
+
+    ## Returns number of rows in table
+    def count_rows (self,table_name) :
+        request_dict = {
+            "table_name" : table_name
+            }
+        return self.send_rpc_request ("count_rows", request_dict)
+    ## Returns list of table names
+    def list_tables (self) :
+        request_dict = {}
+        return self.send_rpc_request ("list_tables", request_dict)
+    ## Returns table row count, bytes and min/max key
+    def table_stats (self,table_name) :
+        request_dict = {
+            "table_name" : table_name
+            }
+        return self.send_rpc_request ("table_stats", request_dict)
+
+    ## Create index on column(s)
+    def create_index (self,table_name,columns,unique=False) :
+        request_dict = {
+            "table_name" : table_name ,
+            "columns" : columns ,
+            "unique" : unique
+            }
+        return self.send_rpc_request ("create_index", request_dict)
+    ## Remove index
+    def drop_index (self,table_name,index) :
+        request_dict = {
+            "table_name" : table_name ,
+            "index" : index
+            }
+        return self.send_rpc_request ("drop_index", request_dict)
+    ## Returns list of rows from table using index
+    def read_rows_by_index (self,table_name,index,value,limit=999999,where=None,columns=None) :
+        request_dict = {
+            "table_name" : table_name ,
+            "index" : index ,
+            "value" : value ,
+            "limit" : limit ,
+            "where" : where ,
+            "columns" : columns
+            }
+        return self.send_rpc_request ("read_rows_by_index", request_dict)
+
+    ## Generators, yield every key/row/item, following next_token
+    # limit is the page size (the server may use less), not the total
+    def iter_table_keys (self,table_name,start_key=None,end_key=None,limit=999999) :
+        request_dict = {
+            "table_name" : table_name ,
+            "start_key" : start_key ,
+            "end_key" : end_key ,
+            "limit" : limit
+            }
+        return self.iter_pages ("get_table_keys", request_dict)
+    def iter_table_rows (self,table_name,start_key=None,end_key=None,limit=999999,where=None,columns=None) :
+        request_dict = {
+            "table_name" : table_name ,
+            "start_key" : start_key ,
+            "end_key" : end_key ,
+            "limit" : limit ,
+            "where" : where ,
+            "columns" : columns
+            }
+        return self.iter_pages ("get_table_rows", request_dict)
+    def iter_table_items (self,table_name,start_key=None,end_key=None,limit=999999,where=None,columns=None) :
+        request_dict = {
+            "table_name" : table_name ,
+            "start_key" : start_key ,
+            "end_key" : end_key ,
+            "limit" : limit ,
+            "where" : where ,
+            "columns" : columns
+            }
+        return self.iter_pages ("get_table_items", request_dict)
+    def iter_prefix (self,table_name,key_prefix,limit=999999,where=None,columns=None) :
+        request_dict = {
+            "table_name" : table_name ,
+            "key_prefix" : key_prefix ,
+            "limit" : limit ,
+            "where" : where ,
+            "columns" : columns
+            }
+        return self.iter_pages ("scan_prefix", request_dict)
+    def iter_rows_by_index (self,table_name,index,value,limit=999999,where=None,columns=None) :
+        request_dict = {
+            "table_name" : table_name ,
+            "index" : index ,
+            "value" : value ,
+            "limit" : limit ,
+            "where" : where ,
+            "columns" : columns
+            }
+        return self.iter_pages ("read_rows_by_index", request_dict)
+
+    ## Generator, yields results of a paged method page by page
+    # While a page is used the next page is read by a prefetch thread
+    # Raises RuntimeError if a page request fails
+    def iter_pages (self, method, request_dict) :
+        prefetch = None
+        if ThreadPoolExecutor is not None :
+            prefetch = ThreadPoolExecutor (max_workers = 1)
+        try :
+            reply = self.send_rpc_reply (method, dict (request_dict, page_token = ""))
+            while True :
+                check_page_reply (method, reply)
+                next_token = reply.get ("next_token")
+                next_reply = None
+                if next_token is not None :
+                    next_params = dict (request_dict, page_token = next_token)
+                    if prefetch is not None :
+                        next_reply = prefetch.submit (self.send_rpc_reply, method, next_params)
+                    else :
+                        next_reply = next_params
+                for _, result in enumerate (reply ["result"]) :
+                    yield result
+                if next_reply is None :
+                    return
+                if prefetch is not None :
+                    reply = next_reply.result ()
+                else :
+                    reply = self.send_rpc_reply (method, next_reply)
+        finally :
+            if prefetch is not None :
+                prefetch.shutdown (wait = True)
+
+    ## Generators, yield every key/row/item sent by a stream request
+    # limit is the total number of rows, Default: None, all rows
+    def stream_table_keys (self,table_name,start_key=None,end_key=None,limit=None) :
+        request_dict = {
+            "table_name" : table_name ,
+            "start_key" : start_key ,
+            "end_key" : end_key ,
+            "limit" : limit
+            }
+        return self.iter_stream ("get_table_keys", request_dict)
+    def stream_table_rows (self,table_name,start_key=None,end_key=None,limit=None,where=None,columns=None) :
+        request_dict = {
+            "table_name" : table_name ,
+            "start_key" : start_key ,
+            "end_key" : end_key ,
+            "limit" : limit ,
+            "where" : where ,
+            "columns" : columns
+            }
+        return self.iter_stream ("get_table_rows", request_dict)
+    def stream_table_items (self,table_name,start_key=None,end_key=None,limit=None,where=None,columns=None) :
+        request_dict = {
+            "table_name" : table_name ,
+            "start_key" : start_key ,
+            "end_key" : end_key ,
+            "limit" : limit ,
+            "where" : where ,
+            "columns" : columns
+            }
+        return self.iter_stream ("get_table_items", request_dict)
+    def stream_prefix (self,table_name,key_prefix,limit=None,where=None,columns=None) :
+        request_dict = {
+            "table_name" : table_name ,
+            "key_prefix" : key_prefix ,
+            "limit" : limit ,
+            "where" : where ,
+            "columns" : columns
+            }
+        return self.iter_stream ("scan_prefix", request_dict)
+    def stream_rows_by_index (self,table_name,index,value,limit=None,where=None,columns=None) :
+        request_dict = {
+            "table_name" : table_name ,
+            "index" : index ,
+            "value" : value ,
+            "limit" : limit ,
+            "where" : where ,
+            "columns" : columns
+            }
+        return self.iter_stream ("read_rows_by_index", request_dict)
+
+    ## Generator, posts a stream request and yields rows as they arrive
+    # Each line is one json row, the last line is the json rpc reply.
+    # Raises RuntimeError after the last row if the stream failed or was cut off
+    def iter_stream (self, method, params) :
+        response = None
+        last_line = None
+        start_ms = ticks_ms ()
+        error = False
+        try :
+            response = self.post_stream (method, params)
+            if response.status_code != 200 :
+                raise RuntimeError (method + " stream failed: HTTP " + str (response.status_code))
+            for line in self.response_lines (response) :
+                if len (line) == 0 :
+                    continue
+                if last_line is not None :
+                    yield json.loads (last_line)   # not the last line
+                last_line = line
+        except Exception :
+            error = True
+            raise
+        finally :
+            if response is not None :
+                response.close ()
+            self.count_stream (start_ms, error)
+        reply = None
+        if last_line is not None :
+            reply = json.loads (last_line)
+        if not isinstance (reply, dict) or "result" not in reply :
+            self.count_stream (None, True)
+            if isinstance (reply, dict) and "error" in reply :
+                raise RuntimeError (method + " stream failed: " + str (reply ["error"]))
+            raise RuntimeError (method + " stream cut off")
+    ## Posts a stream request, returns the response
+    def post_stream (self, method, params) :
+        self.request_lock.acquire ()
+        try :
+            self.id += 1
+            rpc_dict = {
+                "jsonrpc" : "2.0" ,
+                "method" : method ,
+                "params" : params ,
+                "id" : str (self.id)
+                }
+            if self.session is not None :
+                return self.session.post (self.url + "/stream" ,
+                                            json = rpc_dict ,
+                                            headers = {"Content-Type" : JSON_CONTENT_TYPE} ,
+                                            timeout = self.timeout ,
+                                            stream = True)
+            self.request_stats ["connections"] += 1
+            return requests.post (self.url + "/stream" ,
+                                    json = rpc_dict ,
+                                    headers = {"Content-Type" : JSON_CONTENT_TYPE} ,
+                                    timeout = self.timeout ,
+                                    stream = True)
+        finally :
+            self.request_lock.release ()
+    ## Counts a stream in request_stats, start_ms None only counts the error
+    def count_stream (self, start_ms, error) :
+        self.request_lock.acquire ()
+        try :
+            if error :
+                self.request_stats ["errors"] += 1
+            if start_ms is None :
+                return
+            request_ms = ticks_diff (ticks_ms (), start_ms)
+            self.request_stats ["requests"] += 1
+            self.request_stats ["total_ms"] += request_ms
+            self.request_stats ["last_ms"] = request_ms
+            if request_ms > self.request_stats ["max_ms"] :
+                self.request_stats ["max_ms"] = request_ms
+        finally :
+            self.request_lock.release ()
+    ## Returns an iterator of response body lines
+    def response_lines (self, response) :
+        if hasattr (response, "iter_lines") :
+            return response.iter_lines ()
+        return iter (response.raw.readline, b"")     # MicroPython requests
+
     ## dump_all
     def dump_all (self, file_path = "db_dump.txt") :
         request_dict = {
@@ -198,15 +715,66 @@ class SimpleDBClient :
             "file_path" : file_path
             }
         return self.send_rpc_request ("load", request_dict)
+    ## bulk_load
+    def bulk_load (self, file_path = "db_dump.txt", batch_size = 1000, verify = False) :
+        request_dict = {
+            "file_path" : file_path ,
+            "batch_size" : batch_size ,
+            "verify" : verify
+            }
+        return self.send_rpc_request ("bulk_load", request_dict)
+
+    ## Re-encode server database rows with new_codec
+    def recode (self, new_codec) :
+        request_dict = {
+            "new_codec" : new_codec
+            }
+        return self.send_rpc_request ("recode", request_dict)
 
     ## commit updates(s), if autocommit is not set
     def commit (self) :
         request_dict = {}
         return self.send_rpc_request ("commit", request_dict)
+    ## Group commit, commits server pending writes if they are due
+    def commit_due (self) :
+        request_dict = {}
+        return self.send_rpc_request ("commit_due", request_dict)
+    ## Returns server row cache counters
+    def get_cache_stats (self) :
+        request_dict = {}
+        return self.send_rpc_request ("get_cache_stats", request_dict)
+    ## Returns server commit counters
+    def get_commit_stats (self) :
+        request_dict = {}
+        return self.send_rpc_request ("get_commit_stats", request_dict)
+
+
+    ## Returns a batch, calls are queued and sent as one JSON-RPC batch
+    def batch (self) :
+        return SimpleDBBatch (self)
 
+    ## Returns read cache counters, None without a cache (cache_rows=0)
+    #   hits, used without a request, revalidated, the server replied not_modified
+    #   hit_rate = (hits + revalidated) / reads
+    def get_read_cache_stats (self) :
+        if self.read_cache is None :
+            return None
+        return self.read_cache.get_stats ()
+
+    ## Returns request counters
+    #   connections, new connections opened, reused = requests - connections
+    #   total_ms, last_ms, max_ms, avg_ms, request round trip times
+    def get_request_stats (self) :
+        request_stats = dict (self.request_stats)
+        request_stats ["reused"] = max (0, request_stats ["requests"] - request_stats ["connections"])
+        request_stats ["avg_ms"] = 0
+        if request_stats ["requests"] > 0 :
+            request_stats ["avg_ms"] = request_stats ["total_ms"] / request_stats ["requests"]
+        return request_stats
 
     def close (self) :
-        pass
+        if self.session is not None :
+            self.session.close ()
 
     ## Utilities
     def get_date_time_server (self, epoch_seconds = None) :
@@ -245,24 +813,220 @@ class SimpleDBClient :
         return TIME_FORMAT.format (local_time[3],local_time[4],local_time[5])
 
     def send_rpc_request (self, method, params) :
-        self.id += 1
-        rpc_dict = {
-            "jsonrpc" : "2.0" ,
-            "method" : method ,
-            "params" : params ,
-            "id" : str (self.id)
-            }
-        ## Send request to server
-        reply = send_request (rpc_dict)
+        reply = self.send_rpc_reply (method, params)
         if reply is not None :
             if "result" in reply :
                 return reply ["result"]
             elif "error" in reply :
                 pass   # Do something here?
         return None
+    ## Returns the whole reply dict, None on error
+    def send_rpc_reply (self, method, params) :
+        self.request_lock.acquire ()
+        try :
+            self.id += 1
+            rpc_dict = {
+                "jsonrpc" : "2.0" ,
+                "method" : method ,
+                "params" : params ,
+                "id" : str (self.id)
+                }
+            ## Send request to server
+            reply = self.send_request (rpc_dict)
+            self.cache_write (method, params)
+        finally :
+            self.request_lock.release ()
+        if isinstance (reply, dict) :
+            return reply
+        return None
+
+    ## Read cache, cache_rows=0 is no cache
+    def open_read_cache (self, cache_rows, cache_ttl) :
+        self.read_cache = None
+        if cache_rows > 0 :
+            self.read_cache = ReadCache (cache_rows)
+        self.cache_ttl_ms = int (cache_ttl * 1000)
+    ## Returns the result of a cached read method, the server replies
+    # not_modified if the table generation has not changed
+    def send_cached_request (self, method, params) :
+        if self.read_cache is None :
+            return self.send_rpc_request (method, params)
+        cache_key = json.dumps ([method, params])
+        slot = self.read_cache.get (cache_key)
+        if slot is not None :
+            if ticks_diff (ticks_ms (), slot [4]) < self.cache_ttl_ms :
+                self.read_cache.hits += 1
+                return slot [3]
+            params = dict (params, generation = slot [2])
+        reply = self.send_rpc_reply (method, params)
+        if reply is None or "result" not in reply :
+            return None
+        if reply.get ("not_modified", False) and slot is not None :
+            self.read_cache.revalidated += 1
+            slot [4] = ticks_ms ()
+            return slot [3]
+        self.read_cache.misses += 1
+        if "generation" in reply :      # older servers have no generations
+            self.read_cache.put (cache_key, params ["table_name"], reply ["generation"], reply ["result"])
+        return reply ["result"]
+    ## Drops cached reads a write method may have changed
+    def cache_write (self, method, params) :
+        if self.read_cache is not None and method in WRITE_METHODS :
+            self.read_cache.invalidate_table (params.get ("table_name"))
+
+    ## Sends json rpc request (dict or batch list) to the server
+    # The RPC reply is returned as a dict (list for a batch) or None on error
+    def send_request (self, rpc_data) :
+        response = None
+        start_ms = ticks_ms ()
+        try :
+            if self.session is not None :
+                response = self.session.post (self.url ,
+                                                data = self.encode_request (rpc_data) ,
+                                                timeout = self.timeout)
+            else :
+                self.request_stats ["connections"] += 1
+                response = requests.post (self.url ,
+                                            data = self.encode_request (rpc_data) ,
+                                            headers = self.post_headers ,
+                                            timeout = self.timeout)
+            #print ("send_rpc: reply:",response.content)
+            return self.decode_reply (response.content, response.headers.get ("Content-Type"))
+        except Exception as e :
+            print ("requests.post:", e)
+            self.request_stats ["errors"] += 1
+        finally :
+            request_ms = ticks_diff (ticks_ms (), start_ms)
+            self.request_stats ["requests"] += 1
+            self.request_stats ["total_ms"] += request_ms
+            self.request_stats ["last_ms"] = request_ms
+            if request_ms > self.request_stats ["max_ms"] :
+                self.request_stats ["max_ms"] = request_ms
+            if response is not None and self.session is None :
+                response.close ()     # pooled responses go back to the pool
+        ## report error here
+        return None
+
+    ## Returns rpc_data as request body bytes in the wire format
+    def encode_request (self, rpc_data) :
+        if self.wire == MSGPACK_CONTENT_TYPE :
+            return umsgpack.dumps (rpc_data)
+        return json.dumps (rpc_data).encode ()
+    ## Returns the decoded reply body, a msgpack reply switches requests to msgpack
+    def decode_reply (self, body, content_type) :
+        if content_type is not None and content_type.startswith (MSGPACK_CONTENT_TYPE) :
+            if self.wire != MSGPACK_CONTENT_TYPE :
+                self.wire = MSGPACK_CONTENT_TYPE
+                self.post_headers ["Content-Type"] = MSGPACK_CONTENT_TYPE
+                if self.session is not None :
+                    self.session.headers.update (self.post_headers)
+            return umsgpack.loads (body)
+        return json.loads (body)
 
 # end SimpleDBClient  #
 
+## SimpleDBBatchResult - Result of a batched call, set when the batch is sent
+class SimpleDBBatchResult :
+    def __init__ (self, method) :
+        self.method = method
+        self.done = False
+        self.value = None
+        self.error = None      # {"code" : n, "message" : text} on error
+
+    ## Returns the call result, None on error
+    def result (self) :
+        if not self.done :
+            raise RuntimeError ("Batch not sent: " + self.method)
+        return self.value
+
+## SimpleDBBatch - Queues SimpleDBClient calls, send () posts them as one
+# JSON-RPC batch. Each call returns a SimpleDBBatchResult.
+#
+# Notes:
+#   o The batch is sent at the end of a with block (not if it raised)
+#   o get_configuration, iter_table_rows etc. and stream_table_rows etc.
+#     can not be batched
+#   o get_date_time,get_date,get_time still return local time at once
+#
+class SimpleDBBatch (SimpleDBClient) :
+    def __init__ (self, client) :
+        SimpleDBClient.__init__ (self)
+        self.client = client
+        self.calls = []        # (rpc_dict, SimpleDBBatchResult)
+        ## Stats and the read cache are the client's
+        self.request_lock = client.request_lock
+        self.read_cache = client.read_cache
+        self.request_stats = client.request_stats
+
+    ## Requests are sent by the client
+    def open_session (self) :
+        pass
+
+    def __enter__ (self) :
+        return self
+    def __exit__ (self, exc_type, exc_value, traceback) :
+        if exc_type is None :
+            self.send ()
+        return False
+
+    ## Queue request, returns its SimpleDBBatchResult
+    def send_rpc_request (self, method, params) :
+        self.client.cache_write (method, params)
+        self.client.request_lock.acquire ()
+        self.client.id += 1
+        rpc_id = str (self.client.id)
+        self.client.request_lock.release ()
+        rpc_dict = {
+            "jsonrpc" : "2.0" ,
+            "method" : method ,
+            "params" : params ,
+            "id" : rpc_id
+            }
+        batch_result = SimpleDBBatchResult (method)
+        self.calls.append ((rpc_dict, batch_result))
+        return batch_result
+
+    ## Send queued requests, replies are matched to results by "id"
+    def send (self) :
+        if len (self.calls) == 0 :
+            return
+        calls = self.calls
+        self.calls = []
+        self.client.request_lock.acquire ()
+        try :
+            replies = self.client.send_request ([rpc_dict for rpc_dict, _ in calls])
+        finally :
+            self.client.request_lock.release ()
+        reply_ids = {}
+        if isinstance (replies, list) :
+            for _, reply in enumerate (replies) :
+                if isinstance (reply, dict) and "id" in reply :
+                    reply_ids [reply ["id"]] = reply
+        for _, (rpc_dict, batch_result) in enumerate (calls) :
+            batch_result.done = True
+            reply = reply_ids.get (rpc_dict ["id"])
+            if reply is None :
+                if isinstance (replies, dict) and "error" in replies :
+                    batch_result.error = replies ["error"]     # whole batch failed
+                else :
+                    batch_result.error = {"code" : None, "message" : "No reply"}
+            elif "result" in reply :
+                batch_result.value = reply ["result"]
+            elif "error" in reply :
+                batch_result.error = reply ["error"]
+
+    ## Batched reads are not cached
+    def send_cached_request (self, method, params) :
+        return self.send_rpc_request (method, params)
+    def get_configuration (self) :
+        raise RuntimeError ("get_configuration can not be batched")
+    def iter_pages (self, method, request_dict) :
+        raise RuntimeError (method + " pages can not be batched")
+    def iter_stream (self, method, params) :
+        raise RuntimeError (method + " streams can not be batched")
+
+# end SimpleDBBatch  #
+
 def main () :
     import os
     #print (os.uname())
@@ -322,6 +1086,8 @@ def main () :
     print ("bad read:", my_db.read_row ("customer", "000199")) # bad key
     print ("all keys:", my_db.get_table_keys ("customer"))
     print ("rows:", my_db.get_table_rows ("customer", "000500", "990000"))
+    print ("iter rows:", [row ["name"] for row in my_db.iter_table_rows ("customer", limit=2)])
+    print ("stream rows:", [row ["name"] for row in my_db.stream_table_rows ("customer")])
     #
     #my_db.get_table_items ("customer")
 
@@ -340,6 +1106,12 @@ def main () :
         print ("row:", row)
         row = my_db.next_row ("log", row[0])
     #
+    with my_db.batch () as batch :
+        customer = batch.read_row ("customer", "000100")
+        lines = batch.scan_prefix ("invoice_line", "090001")
+    print ("batch:", customer.result (), len (lines.result ()))
+    print ("request stats:", my_db.get_request_stats ())
+    #
     my_db.commit ()
     my_db.dump_all ()
     my_db.close ()
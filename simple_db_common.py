@@ -0,0 +1,503 @@
+#
+################################################################################
+# The MIT License (MIT)
+#
+# Copyright (c) 2025 Curt Timmerman
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+################################################################################
+#
+## SimpleDB common - Helpers shared by simple_db.py and simple_db_btrees.py
+#
+# Notes:
+#   o Nothing here uses the database engine, both back ends import it
+#   o Runs on MicroPython, keep it free of CPython only modules
+#
+################################################################################
+
+import time
+
+## Required by the json codec
+import json
+## Page tokens
+import binascii
+
+## Reserved table names
+META_TABLE = "__meta"
+INDEX_TABLE = "__idx"
+INDEX_NAME_SEPARATOR = "+"
+RESERVED_PREFIX = b"__"     # table names starting with "__" are reserved
+CODEC_META = "codec"
+KEY_ENCODING_META = "key_encoding"
+CATALOG_META = "catalog"
+FILE_META = (CODEC_META, KEY_ENCODING_META, CATALOG_META)   # not copied by dump_all
+
+## Key encodings
+# "text", table name and key values joined with key_separator (default)
+# "tuple", type tagged, order preserving binary keys
+#   o int key values sort numerically, str key values sort by utf-8 bytes
+#   o key values may contain key_separator
+#   o all keys with a given prefix sort below prefix + b"\xff"
+#   o key values are int (64 bit signed) or str, bool is stored as int,
+#     other types (None, float) raise ValueError, rows with them in an
+#     indexed column are not indexed
+KEY_ENCODING_TEXT = "text"
+KEY_ENCODING_TUPLE = "tuple"
+KEY_TAG_INT = 0x03
+KEY_TAG_STR = 0x05
+KEY_INT_OFFSET = 1 << 63      # 64 bit signed int keys
+KEY_PREFIX_END = b"\xff"       # above every key tag
+
+## Returns tuple encoded btree key from list of key values
+def encode_tuple_key (key_values) :
+    db_key = b""
+    for _, key_value in enumerate (key_values) :
+        if isinstance (key_value, int) :
+            if key_value < -KEY_INT_OFFSET or key_value >= KEY_INT_OFFSET :
+                raise ValueError ("Key value out of range: " + str (key_value))
+            db_key += bytes ([KEY_TAG_INT]) \
+                    + (key_value + KEY_INT_OFFSET).to_bytes (8, "big")
+        elif isinstance (key_value, str) :
+            ## 0x00 terminates the string, embedded 0x00 is escaped as 0x00 0xff
+            db_key += bytes ([KEY_TAG_STR]) \
+                    + key_value.encode ().replace (b"\x00", b"\x00\xff") \
+                    + b"\x00"
+        else :
+            raise ValueError ("Key value must be int or str: " + str (key_value))
+    return db_key
+## Returns list of key values from tuple encoded btree key
+def decode_tuple_key (db_key) :
+    key_values = []
+    position = 0
+    while position < len (db_key) :
+        tag = db_key [position]
+        position += 1
+        if tag == KEY_TAG_INT :
+            key_values.append (int.from_bytes (db_key [position:position + 8], "big")
+                                - KEY_INT_OFFSET)
+            position += 8
+        elif tag == KEY_TAG_STR :
+            end = db_key.find (b"\x00", position)
+            while end >= 0 and end + 1 < len (db_key) and db_key [end + 1] == 0xff :
+                end = db_key.find (b"\x00", end + 2)     # escaped 0x00
+            if end < 0 :
+                raise ValueError ("Bad tuple key: " + str (db_key))
+            key_values.append (db_key [position:end].replace (b"\x00\xff", b"\x00").decode ())
+            position = end + 1
+        else :
+            raise ValueError ("Bad tuple key: " + str (db_key))
+    return key_values
+## Group commit defaults
+COMMIT_AUTO = "auto"        # commit after every update
+COMMIT_MANUAL = "manual"    # application calls commit ()
+COMMIT_GROUP = "group"      # commit after N writes or T milliseconds
+GROUP_COMMIT_WRITES = 100
+GROUP_COMMIT_MS = 1000
+## Rows committed per batch by bulk_load
+BULK_LOAD_BATCH_SIZE = 1000
+
+## millisecond timer, time.ticks_ms is MicroPython only
+try :
+    ticks_ms = time.ticks_ms
+    ticks_diff = time.ticks_diff
+except AttributeError :
+    ticks_ms = lambda : int (time.monotonic () * 1000)
+    ticks_diff = lambda end_ms, start_ms : end_ms - start_ms
+
+## Row codecs, name : function returning (dumps, loads)
+# The codec modules are imported when the codec is first used
+# marshal and pickle are CPython only, never open untrusted pickle files
+def json_codec () :
+    return (lambda row_data : bytes (json.dumps (row_data).encode()) ,
+            lambda row : json.loads (row.decode()))
+def umsgpack_codec () :
+    import umsgpack
+    return (umsgpack.dumps, umsgpack.loads)
+def marshal_codec () :
+    import marshal
+    return (marshal.dumps, marshal.loads)
+def pickle_codec () :
+    import pickle
+    return (lambda row_data : pickle.dumps (row_data, pickle.HIGHEST_PROTOCOL) ,
+            pickle.loads)
+CODECS = {
+    "json" : json_codec ,
+    "umsgpack" : umsgpack_codec ,
+    "marshal" : marshal_codec ,
+    "pickle" : pickle_codec
+    }
+
+## Default codec for new databases
+USE_JSON = True
+DEFAULT_CODEC = "json" if USE_JSON else "umsgpack"
+
+## UniqueIndexError - A write would give two rows the same unique index value
+# Raised by write_row, write_rows and rewrite_row, nothing is written
+class UniqueIndexError (ValueError) :
+    pass
+
+## RowCache - Bounded cache of decoded rows
+#
+# Notes:
+#   o CLOCK (second chance) eviction, close to LRU without a linked list
+#   o Entries are kept in a list of slots, the dict maps btree key to slot
+#   o Limited by number of rows and/or bytes (stored row size)
+#   o Cached rows are shared, callers get a copy (see copy_row)
+#
+class RowCache :
+    def __init__ (self,max_rows=0,max_bytes=0) :
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.slot_index = {}     # btree key : slot number
+        self.slots = []          # [btree key, row, size, referenced]
+        self.free_slots = []
+        self.hand = 0
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    ## Returns cached row, None if not cached
+    def get (self,db_key) :
+        slot_number = self.slot_index.get (db_key)
+        if slot_number is None :
+            self.misses += 1
+            return None
+        slot = self.slots [slot_number]
+        slot [3] = True
+        self.hits += 1
+        return slot [1]
+    ## Add or replace row, size is the stored row size in bytes
+    def put (self,db_key,row,size) :
+        self.invalidate (db_key)
+        if self.max_bytes > 0 and size > self.max_bytes :
+            return                   # never fits
+        slot = [db_key, row, size, False]
+        if len (self.free_slots) > 0 :
+            slot_number = self.free_slots.pop ()
+            self.slots [slot_number] = slot
+        else :
+            slot_number = len (self.slots)
+            self.slots.append (slot)
+        self.slot_index [db_key] = slot_number
+        self.bytes += size
+        self.evict (db_key)
+    ## Remove row from cache
+    def invalidate (self,db_key) :
+        slot_number = self.slot_index.pop (db_key, None)
+        if slot_number is not None :
+            self.bytes -= self.slots [slot_number][2]
+            self.slots [slot_number] = None
+            self.free_slots.append (slot_number)
+    def clear (self) :
+        self.slot_index = {}
+        self.slots = []
+        self.free_slots = []
+        self.hand = 0
+        self.bytes = 0
+    ## Evict rows until the cache is within its limits, keep_key is not evicted
+    def evict (self,keep_key) :
+        while (self.max_rows > 0 and len (self.slot_index) > self.max_rows) \
+        or (self.max_bytes > 0 and self.bytes > self.max_bytes) :
+            if self.hand >= len (self.slots) :
+                self.hand = 0
+            slot = self.slots [self.hand]
+            if slot is not None and slot [0] != keep_key :
+                if slot [3] :
+                    slot [3] = False         # second chance
+                else :
+                    self.invalidate (slot [0])
+                    self.evictions += 1
+            self.hand += 1
+    def get_stats (self) :
+        return {
+            "rows" : len (self.slot_index) ,
+            "bytes" : self.bytes ,
+            "max_rows" : self.max_rows ,
+            "max_bytes" : self.max_bytes ,
+            "hits" : self.hits ,
+            "misses" : self.misses ,
+            "evictions" : self.evictions
+            }
+
+## Returns a shallow copy of a dict or list row
+def copy_row (row) :
+    if isinstance (row, dict) :
+        return dict (row)
+    if isinstance (row, list) :
+        return list (row)
+    return row
+
+## RawRow - Row returned by raw reads, db_row is the stored row bytes in
+# the "umsgpack" codec format, the server copies them into msgpack replies
+class RawRow :
+    def __init__ (self, db_row) :
+        self.db_row = db_row
+
+## Row filters, where is a json predicate:
+#   {"eq" : [column, value]}, also "ne", "lt" and "gt"
+#   {"in" : [column, [value, ...]]}
+#   {"prefix" : [column, "text"]}
+#   {"and" : [predicate, ...]}, {"or" : [predicate, ...]}
+# A missing column is None, lt/gt compare numbers (decimal strings too) by value
+def match_row (row, where) :
+    if where is None :
+        return True
+    for _, (operator, operands) in enumerate (where.items ()) :
+        if operator == "and" :
+            for _, predicate in enumerate (operands) :
+                if not match_row (row, predicate) :
+                    return False
+        elif operator == "or" :
+            matched = False
+            for _, predicate in enumerate (operands) :
+                if match_row (row, predicate) :
+                    matched = True
+                    break
+            if not matched :
+                return False
+        elif operator not in WHERE_OPERATORS :
+            raise ValueError ("Unknown where operator: " + str (operator))
+        else :
+            value = row_value (row, operands [0])
+            if operator == "eq" :
+                matched = value == operands [1]
+            elif operator == "ne" :
+                matched = value != operands [1]
+            elif operator == "in" :
+                matched = value in operands [1]
+            elif operator == "prefix" :
+                matched = isinstance (value, str) and value.startswith (operands [1])
+            elif value is None :
+                matched = False
+            else :
+                try :
+                    comparison = compare_values (value, operands [1])
+                except TypeError :
+                    return False
+                matched = comparison < 0 if operator == "lt" else comparison > 0
+            if not matched :
+                return False
+    return True
+WHERE_OPERATORS = ("eq", "ne", "lt", "gt", "in", "prefix")
+## Returns {column : value} for column_list, missing columns are None
+def project_row (row, column_list) :
+    columns = {}
+    for _, col_id in enumerate (column_list) :
+        if isinstance (row, list) :
+            if isinstance (col_id, int) and col_id >= 0 and col_id < len (row) :
+                columns [col_id] = row [col_id]     # Valid column id
+            else :
+                columns [col_id] = None             # Bad column id
+        else :
+            columns [col_id] = row.get (col_id)
+    return columns
+## Generator, yields the values of up to limit (key, value) items
+def item_values (items, limit=None) :
+    if limit is not None and limit <= 0 :
+        return
+    count = 0
+    for _, value in items :
+        yield value
+        count += 1
+        if limit is not None and count >= limit :
+            return
+## Returns a page of up to limit values from (btree key, value) items
+#   {"rows" : [value, ...], "next_token" : token or None}
+# next_token is the hex btree key of the next item, pass it back as
+# page_token to continue, None when there are no more items
+# A limit below 1 is read as 1, every page moves on by at least one item
+def read_page (items, limit) :
+    limit = max (1, limit)
+    values = []
+    for db_key, value in items :
+        if len (values) >= limit :
+            return {"rows" : values, "next_token" : binascii.hexlify (db_key).decode ()}
+        values.append (value)
+    return {"rows" : values, "next_token" : None}
+## Returns row column value, None if missing
+def row_value (row, column) :
+    if isinstance (row, dict) :
+        return row.get (column)
+    if isinstance (row, list) and isinstance (column, int) \
+    and column >= -len (row) and column < len (row) :
+        return row [column]
+    return None
+
+## Decimal numbers, exact arithmetic for decimal strings such as "100.00"
+# A decimal is (units, scale), value = units / 10 ** scale
+def parse_decimal (value) :
+    if isinstance (value, bool) :
+        return None
+    if isinstance (value, int) :
+        return (value, 0)
+    if isinstance (value, float) :
+        value = repr (value)       # shortest text that reads back the same float
+    if not isinstance (value, str) :
+        return None
+    text = value.strip ().lower ()
+    exponent = 0
+    if "e" in text :
+        text, _, exponent_text = text.partition ("e")
+        try :
+            exponent = int (exponent_text)
+        except ValueError :
+            return None
+    sign = 1
+    if text [:1] in ("-", "+") :
+        if text [0] == "-" :
+            sign = -1
+        text = text [1:]
+    whole, _, fraction = text.partition (".")
+    digits = whole + fraction
+    if len (digits) == 0 or not digits.isdigit () :
+        return None
+    units = sign * int (digits)
+    scale = len (fraction) - exponent
+    if scale < 0 :
+        units *= 10 ** (-scale)
+        scale = 0
+    return (units, scale)
+## Returns decimal units at a larger scale
+def rescale_decimal (decimal, scale) :
+    return decimal [0] * 10 ** (scale - decimal [1])
+## Returns decimal string, scale digits after the decimal point
+def format_decimal (units, scale) :
+    if scale <= 0 :
+        return str (units)
+    sign = "-" if units < 0 else ""
+    digits = str (abs (units))
+    if len (digits) <= scale :
+        digits = "0" * (scale - len (digits) + 1) + digits
+    return sign + digits [:-scale] + "." + digits [-scale:]
+## Returns -1, 0 or 1, numbers (decimal strings too) are compared by value
+# raises TypeError if the values can not be compared (number and text)
+def compare_values (value, other) :
+    decimal = parse_decimal (value)
+    other_decimal = parse_decimal (other)
+    if decimal is not None and other_decimal is not None :
+        scale = max (decimal [1], other_decimal [1])
+        value = rescale_decimal (decimal, scale)
+        other = rescale_decimal (other_decimal, scale)
+    elif decimal is not None or other_decimal is not None :
+        raise TypeError ("Number compared with text")
+    if value < other :
+        return -1
+    if value > other :
+        return 1
+    return 0
+
+## Aggregate functions, see SimpleDB.aggregate
+AGGREGATE_FUNCTIONS = ("count", "sum", "min", "max", "avg")
+AVG_EXTRA_SCALE = 4       # avg decimal places added to the column scale
+## Returns list of (result name, function, column) from aggregations
+# aggregations is a list of [function, column], "count" without a column counts rows
+def aggregate_specs (aggregations) :
+    specs = []
+    for _, aggregation in enumerate (aggregations) :
+        if not isinstance (aggregation, (list, tuple)) :
+            aggregation = [aggregation]
+        function = aggregation [0]
+        column = None
+        if len (aggregation) > 1 :
+            column = aggregation [1]
+        if function not in AGGREGATE_FUNCTIONS :
+            raise ValueError ("Unknown aggregate function: " + str (function))
+        if column is None :
+            if function != "count" :
+                raise ValueError ("Aggregate function needs a column: " + function)
+            specs.append ((function, function, None))
+        else :
+            specs.append ((function + "(" + str (column) + ")", function, column))
+    return specs
+
+## RowAggregate - count/sum/min/max/avg totals for a group of rows
+#
+# Notes:
+#   o Numbers are int, float or decimal strings, sums are exact
+#   o sum/avg return an int if every value was an int, else a decimal string
+#   o min/max return the stored value, numbers are compared by value
+#   o None, missing and (sum/avg) non numeric values are skipped
+#
+class RowAggregate :
+    def __init__ (self,specs) :
+        self.specs = specs
+        self.totals = []
+        for _ in specs :
+            self.totals.append ({"count" : 0, "units" : 0, "scale" : 0, "int" : True, "value" : None})
+
+    def add (self,row) :
+        for position, (_, function, column) in enumerate (self.specs) :
+            total = self.totals [position]
+            if column is None :
+                total ["count"] += 1
+                continue
+            value = row_value (row, column)
+            if value is None :
+                continue
+            if function == "min" or function == "max" :
+                if total ["value"] is not None :
+                    try :
+                        comparison = compare_values (value, total ["value"])
+                    except TypeError :
+                        continue
+                    if (function == "min" and comparison >= 0) \
+                    or (function == "max" and comparison <= 0) :
+                        total ["count"] += 1
+                        continue
+                total ["value"] = value
+            elif function == "sum" or function == "avg" :
+                decimal = parse_decimal (value)
+                if decimal is None :
+                    continue             # not a number
+                if decimal [1] > total ["scale"] :
+                    total ["units"] = rescale_decimal ((total ["units"], total ["scale"]), decimal [1])
+                    total ["scale"] = decimal [1]
+                total ["units"] += rescale_decimal (decimal, total ["scale"])
+                if not isinstance (value, int) :
+                    total ["int"] = False
+            total ["count"] += 1
+    ## Returns {result name : value}
+    def result (self) :
+        results = {}
+        for position, (name, function, _) in enumerate (self.specs) :
+            total = self.totals [position]
+            value = None
+            if function == "count" :
+                value = total ["count"]
+            elif function == "min" or function == "max" :
+                value = total ["value"]
+            elif total ["count"] == 0 :
+                pass
+            elif function == "sum" :
+                if total ["int"] :
+                    value = total ["units"]
+                else :
+                    value = format_decimal (total ["units"], total ["scale"])
+            else :
+                ## avg, rounded half away from zero
+                dividend = abs (total ["units"]) * 10 ** AVG_EXTRA_SCALE
+                quotient = (dividend * 2 + total ["count"]) // (total ["count"] * 2)
+                if total ["units"] < 0 :
+                    quotient = -quotient
+                value = format_decimal (quotient, total ["scale"] + AVG_EXTRA_SCALE)
+            results [name] = value
+        return results
+
+# end RowAggregate  #
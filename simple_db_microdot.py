@@ -26,18 +26,26 @@
 
 import json
 
+import asyncio
+
 from microdot import Microdot
 
-from simple_db_server import SimpleDBServer, SCALAR_PARAMETERS, ARRAY_PARAMETERS
+from simple_db_server import SimpleDBServer, SCALAR_PARAMETERS, ARRAY_PARAMETERS, JSON_CONTENT_TYPE, get_parameter
 
 ################################################################################
 
 db = SimpleDBServer ()
 
+## python, SimpleDBBtrees with several readers
+#from simple_db_workers import SimpleDBWorkers
+#db = SimpleDBWorkers ("server_test.fs", workers = 4)
+
 app = Microdot()
 
+## Handlers are not async, python runs them in threads so requests can
+# run at the same time, micropython runs them one at a time
 @app.route('/', methods=["GET"])
-async def simple_db_get (request):
+def simple_db_get (request):
     #print ("simple_db_microdot_get")
     request_json = {
         "jsonrpc" : "2.0" ,
@@ -52,20 +60,50 @@ async def simple_db_get (request):
     for id in SCALAR_PARAMETERS :
         val = request.args.get (id) # None = id missing
         if val is not None :
-            request_json["params"][id] = str (val)
+            request_json["params"][id] = get_parameter (id, str (val))
     for id in ARRAY_PARAMETERS :
         val = request.args.getlist(id) # always returns array
         if len (val) > 0 :
             request_json["params"][id] = val
     reply = db.process_request (json.dumps (request_json))
     #print ("simple_db_microdot_get: reply:", reply)
-    return reply
+    return db.encode_reply (reply), 200, {"Content-Type" : JSON_CONTENT_TYPE}
 
+## Requests and replies are json or msgpack (Content-Type and Accept headers)
+# Replies are encoded by the server, map keys are strings in both formats
 @app.route('/', methods=['POST'])
-async def simple_db_post (request):
+def simple_db_post (request):
     #print ("simple_db_microdot_post")
-    reply = db.process_request (request.body)
+    reply_type = db.reply_content_type (request.headers.get ("Accept"))
+    reply = db.process_request (request.body ,
+                                content_type = request.content_type ,
+                                reply_type = reply_type)
     #print ("simple_db_microdot_post: reply:", reply)
-    return reply
+    if reply is None :
+        return "", 204          # batch of notifications, no reply
+    return db.encode_reply (reply, reply_type), 200, {"Content-Type" : reply_type}
+
+## Rows are sent as newline delimited json while they are read, the
+# reply is never held in memory, the last line is the json rpc reply
+@app.route('/stream', methods=['POST'])
+async def simple_db_stream (request):
+    return db.process_stream (request.body), 200, {"Content-Type" : "application/x-ndjson"}
+
+## Group commit, pending writes are committed when they are due even if
+# no more writes arrive. python runs commit_due in a thread, requests
+# hold the database lock in threads too.
+async def commit_task (interval_ms) :
+    while True :
+        await asyncio.sleep (interval_ms / 1000)
+        if hasattr (asyncio, "to_thread") :
+            await asyncio.to_thread (db.commit_due)
+        else :
+            db.commit_due ()
+
+async def main () :
+    interval_ms = db.commit_interval_ms ()
+    if interval_ms is not None :
+        asyncio.create_task (commit_task (interval_ms))
+    await app.start_server (port = 8080)
 
-app.run(port = 8080)
+asyncio.run (main ())
@@ -25,12 +25,20 @@
 #
 
 import json
+import struct
+import time
 
 # Run the following with micropython
-from simple_db import SimpleDB, simpledb_available
+from simple_db import SimpleDB, simpledb_available, COMMIT_GROUP
 
 # Run the following with python
-#from simple_db_btrees import SimpleDBBtrees as SimpleDB, simpledb_available
+#from simple_db_btrees import SimpleDBBtrees as SimpleDB, simpledb_available, COMMIT_GROUP
+
+## msgpack wire format is optional
+try :
+    import umsgpack
+except ImportError :
+    umsgpack = None
 
 '''
 From json-rpc documentation
@@ -66,19 +74,37 @@ METHODS = {
     "readonly" : {
         "get_configuration" : {"allowed" : True,"method" : None} ,
         "write_row" : {"allowed" : False,"method" : None} ,
+        "write_rows" : {"allowed" : False,"method" : None} ,
         "rewrite_row" : {"allowed" : False,"method" : None} ,
         "row_exists" : {"allowed" : True ,"method" : None} ,
-        "read_row" : {"allowed" : True ,"method" : None} ,
-        "read_columns" : {"allowed" : True ,"method" : None} ,
+        "read_row" : {"allowed" : True ,"raw" : True ,"cached" : True ,"method" : None} ,
+        "read_columns" : {"allowed" : True ,"cached" : True ,"method" : None} ,
         "first_row" : {"allowed" : True ,"method" : None} ,
         "next_row" : {"allowed" : True ,"method" : None} ,
-        "get_table_keys" : {"allowed" : True ,"limit_max" : 500 ,"method" : None} ,
-        "get_table_rows" : {"allowed" : True ,"limit_max" : 200 ,"method" : None} ,
-        "get_table_items" : {"allowed" : True ,"limit_max" : 100 ,"method" : None} ,
+        "get_table_keys" : {"allowed" : True ,"limit_max" : 500 ,"paged" : True ,"stream" : True ,"method" : None} ,
+        "get_table_rows" : {"allowed" : True ,"raw" : True ,"limit_max" : 200 ,"paged" : True ,"stream" : True ,"method" : None} ,
+        "scan_prefix" : {"allowed" : True ,"raw" : True ,"limit_max" : 200 ,"paged" : True ,"stream" : True ,"method" : None} ,
+        "read_with_children" : {"allowed" : True ,"limit_max" : 200 ,"method" : None} ,
+        "get_table_items" : {"allowed" : True ,"limit_max" : 100 ,"paged" : True ,"stream" : True ,"method" : None} ,
+        "read_rows_by_index" : {"allowed" : True ,"limit_max" : 200 ,"paged" : True ,"stream" : True ,"method" : None} ,
+        "aggregate" : {"allowed" : True ,"method" : None} ,
+        "create_index" : {"allowed" : False,"method" : None} ,
+        "set_schema" : {"allowed" : False,"method" : None} ,
+        "get_schema" : {"allowed" : True ,"method" : None} ,
+        "count_rows" : {"allowed" : True ,"method" : None} ,
+        "list_tables" : {"allowed" : True ,"method" : None} ,
+        "table_stats" : {"allowed" : True ,"method" : None} ,
+        "drop_index" : {"allowed" : False,"method" : None} ,
         "delete_row" : {"allowed" : False,"method" : None} ,
+        "delete_rows" : {"allowed" : False,"method" : None} ,
         "commit" : {"allowed" : True ,"method" : None} ,
+        "commit_due" : {"allowed" : True ,"method" : None} ,
+        "get_commit_stats" : {"allowed" : True ,"method" : None} ,
+        "get_cache_stats" : {"allowed" : True ,"method" : None} ,
         "dump_all" : {"allowed" : False ,"method" : None} ,
         "load" : {"allowed" : False ,"method" : None} ,
+        "bulk_load" : {"allowed" : False ,"method" : None} ,
+        "recode" : {"allowed" : False ,"method" : None} ,
         "get_date_time" : {"allowed" : True ,"method" : None} ,
         "get_date" : {"allowed" : True ,"method" : None} ,
         "get_time" : {"allowed" : True ,"method" : None}
@@ -86,12 +112,23 @@ METHODS = {
     "restricted" : {
         "get_configuration" : {"allowed" : True,"method" : None} ,
         "row_exists" : {"allowed" : True ,"method" : None} ,
-        "read_row" : {"allowed" : True ,"method" : None} ,
-        "read_columns" : {"allowed" : True ,"method" : None} ,
+        "read_row" : {"allowed" : True ,"raw" : True ,"cached" : True ,"method" : None} ,
+        "read_columns" : {"allowed" : True ,"cached" : True ,"method" : None} ,
         "first_row" : {"allowed" : True ,"method" : None} ,
         "next_row" : {"allowed" : True ,"method" : None} ,
-        "get_table_rows" : {"allowed" : True ,"limit_max" : 20 ,"method" : None} ,
+        "get_table_rows" : {"allowed" : True ,"raw" : True ,"limit_max" : 20 ,"paged" : True ,"method" : None} ,
+        "scan_prefix" : {"allowed" : True ,"raw" : True ,"limit_max" : 20 ,"paged" : True ,"method" : None} ,
+        "read_with_children" : {"allowed" : True ,"limit_max" : 20 ,"method" : None} ,
+        "read_rows_by_index" : {"allowed" : True ,"limit_max" : 20 ,"paged" : True ,"method" : None} ,
+        "aggregate" : {"allowed" : True ,"method" : None} ,
+        "get_schema" : {"allowed" : True ,"method" : None} ,
+        "count_rows" : {"allowed" : True ,"method" : None} ,
+        "list_tables" : {"allowed" : True ,"method" : None} ,
+        "table_stats" : {"allowed" : True ,"method" : None} ,
         "commit" : {"allowed" : True ,"method" : None} ,
+        "commit_due" : {"allowed" : True ,"method" : None} ,
+        "get_commit_stats" : {"allowed" : True ,"method" : None} ,
+        "get_cache_stats" : {"allowed" : True ,"method" : None} ,
         "get_date_time" : {"allowed" : True ,"method" : None} ,
         "get_date" : {"allowed" : True ,"method" : None} ,
         "get_time" : {"allowed" : True ,"method" : None}
@@ -99,124 +136,590 @@ METHODS = {
     "open" : {
         "get_configuration" : {"allowed" : True,"method" : None} ,
         "write_row" : {"allowed" : True,"method" : None} ,
+        "write_rows" : {"allowed" : True,"method" : None} ,
         "rewrite_row" : {"allowed" : True,"method" : None} ,
         "row_exists" : {"allowed" : True ,"method" : None} ,
-        "read_row" : {"allowed" : True ,"method" : None} ,
-        "read_columns" : {"allowed" : True ,"method" : None} ,
+        "read_row" : {"allowed" : True ,"raw" : True ,"cached" : True ,"method" : None} ,
+        "read_columns" : {"allowed" : True ,"cached" : True ,"method" : None} ,
         "first_row" : {"allowed" : True ,"method" : None} ,
         "next_row" : {"allowed" : True ,"method" : None} ,
-        "get_table_keys" : {"allowed" : True ,"limit_max" : 1000 ,"method" : None} ,
-        "get_table_rows" : {"allowed" : True ,"limit_max" : 500 ,"method" : None} ,
-        "get_table_items" : {"allowed" : True ,"limit_max" : 200 ,"method" : None} ,
+        "get_table_keys" : {"allowed" : True ,"limit_max" : 1000 ,"paged" : True ,"stream" : True ,"method" : None} ,
+        "get_table_rows" : {"allowed" : True ,"raw" : True ,"limit_max" : 500 ,"paged" : True ,"stream" : True ,"method" : None} ,
+        "scan_prefix" : {"allowed" : True ,"raw" : True ,"limit_max" : 500 ,"paged" : True ,"stream" : True ,"method" : None} ,
+        "read_with_children" : {"allowed" : True ,"limit_max" : 500 ,"method" : None} ,
+        "get_table_items" : {"allowed" : True ,"limit_max" : 200 ,"paged" : True ,"stream" : True ,"method" : None} ,
+        "read_rows_by_index" : {"allowed" : True ,"limit_max" : 500 ,"paged" : True ,"stream" : True ,"method" : None} ,
+        "aggregate" : {"allowed" : True ,"method" : None} ,
+        "create_index" : {"allowed" : True,"method" : None} ,
+        "set_schema" : {"allowed" : True,"method" : None} ,
+        "get_schema" : {"allowed" : True ,"method" : None} ,
+        "count_rows" : {"allowed" : True ,"method" : None} ,
+        "list_tables" : {"allowed" : True ,"method" : None} ,
+        "table_stats" : {"allowed" : True ,"method" : None} ,
+        "drop_index" : {"allowed" : True,"method" : None} ,
         "delete_row" : {"allowed" : True,"method" : None} ,
+        "delete_rows" : {"allowed" : True,"method" : None} ,
         "commit" : {"allowed" : True ,"method" : None} ,
+        "commit_due" : {"allowed" : True ,"method" : None} ,
+        "get_commit_stats" : {"allowed" : True ,"method" : None} ,
+        "get_cache_stats" : {"allowed" : True ,"method" : None} ,
         "dump_all" : {"allowed" : True ,"method" : None} ,
         "load" : {"allowed" : True ,"method" : None} ,
+        "bulk_load" : {"allowed" : True ,"method" : None} ,
+        "recode" : {"allowed" : True ,"method" : None} ,
         "get_date_time" : {"allowed" : True ,"method" : None} ,
         "get_date" : {"allowed" : True ,"method" : None} ,
         "get_time" : {"allowed" : True ,"method" : None}
         }
     }
 
+## Most requests in a JSON-RPC batch (array of requests)
+BATCH_MAX_REQUESTS = 100
+## Stream replies are read and written in pieces of this many rows
+STREAM_PIECE_ROWS = 50
+
+## Wire formats (HTTP Content-Type)
+JSON_CONTENT_TYPE = "application/json"
+MSGPACK_CONTENT_TYPE = "application/msgpack"
+
+## Returns msgpack bytes for value, RawRow bytes are copied unchanged
+# RawRow is found by its db_row attribute, either backend's RawRow works
+# Map keys are strings as in a json reply, e.g. read_columns with
+# integer column ids returns {"0" : ...} in both formats
+def msgpack_dumps (value) :
+    parts = []
+    pack_value (value, parts)
+    return b"".join (parts)
+def pack_value (value, parts) :
+    if hasattr (value, "db_row") :
+        parts.append (value.db_row)         # already msgpack
+    elif isinstance (value, dict) :
+        parts.append (msgpack_header (len (value), 0x80, 0xde))
+        for _, (name, item) in enumerate (value.items ()) :
+            if not isinstance (name, str) :
+                name = json.dumps (name)    # json key: 1 -> "1", None -> "null"
+            pack_value (name, parts)
+            pack_value (item, parts)
+    elif isinstance (value, (list, tuple)) :
+        parts.append (msgpack_header (len (value), 0x90, 0xdc))
+        for _, item in enumerate (value) :
+            pack_value (item, parts)
+    else :
+        parts.append (umsgpack.dumps (value))
+## Returns msgpack map/array header, fix_type for up to 15 entries,
+# type_16 for up to 65535 entries, type_16 + 1 (32 bit count) for more
+def msgpack_header (count, fix_type, type_16) :
+    if count < 16 :
+        return bytes ([fix_type | count])
+    if count < 0x10000 :
+        return bytes ([type_16]) + struct.pack (">H", count)
+    return bytes ([type_16 + 1]) + struct.pack (">I", count)
+
 ## For handling GET parameters
 SCALAR_PARAMETERS = [
     "epoch_seconds" ,
+    "batch_size" ,
     "file_path" ,
+    "index" ,
     "limit" ,
+    "page_token" ,
     "row_data" ,
-    "table_name"
+    "table_name" ,
+    "value"
     ]
+## GET parameters that are numbers, "limit=10" is sent as 10
+INT_PARAMETERS = [
+    "epoch_seconds" ,
+    "batch_size" ,
+    "limit"
+    ]
+## GET parameters that are json numbers or strings if they parse as one,
+# "value=5" is 5, "value=%225%22" ("5") and "value=abc" are strings
+JSON_PARAMETERS = [
+    "value"
+    ]
+## Returns the json rpc value of a GET parameter string
+def get_parameter (parameter, text) :
+    if parameter in INT_PARAMETERS :
+        try :
+            return int (text)
+        except ValueError :
+            return text       # rejected by process_message
+    if parameter in JSON_PARAMETERS :
+        try :
+            value = json.loads (text)
+            if isinstance (value, (int, float, str)) and not isinstance (value, bool) :
+                return value
+        except ValueError :
+            pass
+    return text
 ARRAY_PARAMETERS = [
     "end_key" ,
     "key" ,
+    "key_prefix" ,
     "pk_id" ,
     "column_list" ,
+    "columns" ,
     "start_key"
     ]
 
+## Methods that change the database, see retry_write and TableGenerations
+# Every method holds the database lock, one runs at a time
+WRITE_METHODS = (
+    "write_row" ,
+    "write_rows" ,
+    "rewrite_row" ,
+    "delete_row" ,
+    "delete_rows" ,
+    "create_index" ,
+    "drop_index" ,
+    "set_schema" ,
+    "commit" ,
+    "commit_due" ,
+    "load" ,
+    "bulk_load" ,
+    "recode"
+    )
+
+## Write methods that only commit, they change no table themselves
+COMMIT_METHODS = (
+    "commit" ,
+    "commit_due"
+    )
+
+## Times a write request is repeated after a conflict with another
+# connection to the same database (ZODB ConflictError)
+WRITE_RETRIES = 3
+
+## Thread locks, not available on every MicroPython port
+try :
+    import _thread
+    allocate_lock = _thread.allocate_lock
+except ImportError :
+    allocate_lock = None
+
+## NoLock - Used when there are no threads
+class NoLock :
+    def acquire (self) :
+        return True
+    def release (self) :
+        pass
+
+## Returns a number that differs each time the server starts, boards
+# without a clock can start with the same time
+def generation_epoch () :
+    try :
+        import os
+        return int.from_bytes (os.urandom (4), "big")
+    except Exception :
+        return int (time.time ())
+
+## TableGenerations - Write generation of each table
+# A write changes the generation of the tables written (every table for
+# writes without table_name), with commit_generations only once the
+# write is committed, see SimpleDBServer.write_done.
+# Replies to "cached" methods carry the generation,
+# a client sends it back and gets "not_modified" if the table is unchanged.
+# state is replaced, never changed, copy () is a consistent snapshot.
+class TableGenerations :
+    def __init__ (self, epoch = None) :
+        if epoch is None :
+            epoch = generation_epoch ()    # generations are new after a restart
+        self.epoch = epoch
+        self.writes = 0
+        self.state = (0, {})               # (generation of other tables, {table : generation})
+    ## Returns the generation of table_name
+    def get (self, table_name) :
+        base, tables = self.state
+        return str (self.epoch) + "." + str (tables.get (table_name, base))
+    ## table_name was written, None for every table
+    def changed (self, table_name = None) :
+        self.writes += 1
+        if table_name is None :
+            self.state = (self.writes, {})
+        else :
+            base, tables = self.state
+            tables = dict (tables)
+            tables [table_name] = self.writes
+            self.state = (base, tables)
+    ## Returns the generations now, take it before rows are read
+    def copy (self) :
+        generations = TableGenerations (self.epoch)
+        generations.writes = self.writes
+        generations.state = self.state
+        return generations
+
+## RPCRequest - State of one process_request/process_stream call
+# Nothing about a request is kept on the server, requests can run at once
+class RPCRequest :
+    def __init__ (self, methods, reply_type = JSON_CONTENT_TYPE, generations = None) :
+        self.methods = methods           # SimpleDBServer method set
+        self.reply_type = reply_type
+        self.generations = generations   # TableGenerations copy, taken when the request started
+
+## Returns a new reply dict
+def rpc_reply_dict (rpc_id = None) :
+    return {
+        "jsonrpc" : "2.0" ,
+        "id" : rpc_id
+        }
+## Sets the reply error, error_message replaces the RPC_ERRORS message
+def rpc_error (rpc_reply, error_number, error_message = None) :
+    #print ("rpc_error:", error_number)
+    if error_message is None :
+        error_message = RPC_ERRORS [error_number]
+    rpc_reply ["error"] = {
+        "code" : error_number ,
+        "message" : error_message
+        }
+    return rpc_reply
+
+## Returns the decoded request (dict or batch list), content_type is
+# the request Content-Type, json if not msgpack
+def decode_request (rpc_request, content_type = None) :
+    if content_type is not None and content_type.startswith (MSGPACK_CONTENT_TYPE) :
+        return umsgpack.loads (rpc_request)
+    return json.loads (rpc_request)
+
 class SimpleDBServer :
     def __init__ (self ,
-                    db_file_name = "server_test.db") :
-        ## Set up database methods
-        self.db = SimpleDB (db_file_name)
+                    db_file_name = "server_test.db" ,
+                    db = None ,           # already open database, db_file_name is not used
+                    generations = None ,  # TableGenerations shared with other servers of db
+                    commit_generations = False ,  # other connections read db, see write_done
+                    **db_options) :       # SimpleDB options, e.g. cache_rows
+        ## Set up database methods, each server has its own copy of METHODS
+        if db is None :
+            db = SimpleDB (db_file_name, **db_options)
+        self.db = db
+        self.method_sets = {}
         for _, (method_type, methods) in enumerate (METHODS.items ()) :
-            for _, (method_id, method_data) in enumerate (methods.items ()) :
+            method_set = {}
+            for _, (method_id, method_entry) in enumerate (methods.items ()) :
+                method_data = dict (method_entry)
                 if method_data ["allowed"] :
                     try :
                         method_data ["method"] = getattr (self.db, method_id, None)
                     except Exception :
                         method_data ["allowed"] = False
+                method_data ["write"] = method_id in WRITE_METHODS
+                method_set [method_id] = method_data
+            self.method_sets [method_type] = method_set
 
         ## Set up server
-        self.rpc_reply = None
-        self.methods = None
-
-    def process_request (self, rpc_request, methods = None) :
-        #print ("process_request:", rpc_request)
-        self.rpc_reply = {
-            "jsonrpc" : "2.0" ,
-            "id" : None 
-            }
-        if methods is None :
-            self.methods = METHODS [DEFAULT_METHODS]
-        elif methods in METHODS :
-            self.methods = METHODS [methods]
+        # One request uses the database at a time, reads too: a btree has
+        # one cursor, a ZODB connection is not thread safe and the row
+        # cache changes on every read. SimpleDBWorkers reads at once.
+        if allocate_lock is None :
+            self.db_lock = NoLock ()
         else :
-            self.methods = METHODS [DEFAULT_METHODS]
-        self.process_message (rpc_request)
-        return self.rpc_reply
+            self.db_lock = allocate_lock ()
+        if generations is None :
+            generations = TableGenerations ()
+        self.generations = generations
+        self.commit_generations = commit_generations
+        self.pending_tables = {}      # tables with uncommitted writes, None for every table
+
+    ## Returns the method set for methods ("readonly", "restricted", "open")
+    def get_methods (self, methods = None) :
+        if methods in self.method_sets :
+            return self.method_sets [methods]
+        return self.method_sets [DEFAULT_METHODS]
+
+    ## Returns the reply content type for an HTTP Accept header,
+    # msgpack if the client accepts it and umsgpack is installed
+    def reply_content_type (self, accept = None) :
+        if umsgpack is not None \
+        and accept is not None \
+        and MSGPACK_CONTENT_TYPE in accept :
+            return MSGPACK_CONTENT_TYPE
+        return JSON_CONTENT_TYPE
 
-    def process_message (self, rpc_request) :
-        db_reply = None
+    ## Returns the reply dict, a list of replies for a batch request
+    # or None if every batch request is a notification (no "id")
+    # content_type is the rpc_request format, reply_type the format the
+    # reply will be sent in, use encode_reply for the reply bytes
+    def process_request (self, rpc_request, methods = None ,
+                            content_type = None ,
+                            reply_type = None) :
+        #print ("process_request:", rpc_request)
+        request = RPCRequest (self.get_methods (methods), generations = self.generations.copy ())
+        if reply_type is not None :
+            request.reply_type = reply_type
         try :
-            self.rpc_dict = json.loads (rpc_request)
+            rpc_data = decode_request (rpc_request, content_type)
         except :
-            self.rpc_error (RPC_PARSE_ERROR)
+            return rpc_error (rpc_reply_dict (), RPC_PARSE_ERROR)
+        return self.process_data (request, rpc_data)
+
+    ## Returns the reply for a decoded request (dict or batch list)
+    def process_data (self, request, rpc_data) :
+        if not isinstance (rpc_data, list) :
+            return self.process_message (request, rpc_data)
+        ## Batch, requests are processed in order, notifications get no reply
+        if len (rpc_data) == 0 or len (rpc_data) > BATCH_MAX_REQUESTS :
+            return rpc_error (rpc_reply_dict (), RPC_REQUEST_ERROR)
+        replies = []
+        for _, rpc_dict in enumerate (rpc_data) :
+            rpc_reply = self.process_message (request, rpc_dict)
+            if isinstance (rpc_dict, dict) \
+            and "id" not in rpc_dict \
+            and "method" in rpc_dict :
+                continue          # notification
+            replies.append (rpc_reply)
+        if len (replies) == 0 :
             return None
+        return replies
+
+    ## Returns the process_request reply as bytes in the reply_type format
+    # Rows read raw (msgpack codec) are copied into the reply as stored
+    def encode_reply (self, reply, reply_type = JSON_CONTENT_TYPE) :
+        if reply_type != MSGPACK_CONTENT_TYPE :
+            return json.dumps (reply).encode ()
+        return msgpack_dumps (reply)
+
+    ## Generator, yields the NDJSON reply to a stream request, one json
+    # row per line. The last line is the json rpc reply, "result" is
+    # {"rows" : count} or "error" if the stream failed.
+    # Only "stream" methods can be streamed, limit_max does not apply.
+    # Each piece is a page of the paged method read from the next_token
+    # of the last piece, nothing is kept open between pieces (a btree has
+    # one cursor, other requests move it). The database lock is held
+    # while a piece is read, not between pieces.
+    def process_stream (self, rpc_request, methods = None) :
+        request = RPCRequest (self.get_methods (methods))
+        try :
+            rpc_dict = json.loads (rpc_request)
+        except :
+            yield json.dumps (rpc_error (rpc_reply_dict (), RPC_PARSE_ERROR)) + "\n"
+            return
+        rpc_reply = rpc_reply_dict ()
+        method_data = self.check_message (request, rpc_dict, rpc_reply)
+        if method_data is not None and not method_data.get ("stream", False) :
+            rpc_error (rpc_reply, RPC_METHOD_ERROR)      # method can not be streamed
+            method_data = None
+        if method_data is None :
+            yield json.dumps (rpc_reply) + "\n"
+            return
+        count = 0
+        try :
+            params = dict (rpc_dict ["params"])
+            limit = params.pop ("limit", None)
+            params ["page_token"] = ""
+            while params ["page_token"] is not None :
+                params ["limit"] = STREAM_PIECE_ROWS
+                if limit is not None :
+                    if count >= limit :
+                        break
+                    params ["limit"] = min (STREAM_PIECE_ROWS, limit - count)
+                self.acquire ()
+                try :
+                    page = method_data ["method"] (**params)
+                finally :
+                    self.release ()
+                params ["page_token"] = page ["next_token"]
+                if len (page ["rows"]) > 0 :
+                    count += len (page ["rows"])
+                    yield "\n".join ([json.dumps (row) for row in page ["rows"]] + [""])
+        except Exception as e :
+            rpc_error (rpc_reply, RPC_DB_CALL_ERROR, str(e))
+        else :
+            rpc_reply ["result"] = {"rows" : count}
+        yield json.dumps (rpc_reply) + "\n"
+
+    ## Process one request dict, returns the reply dict
+    def process_message (self, request, rpc_dict) :
+        rpc_reply = rpc_reply_dict ()
+        method_data = self.check_message (request, rpc_dict, rpc_reply)
+        if method_data is None :
+            return rpc_reply
+        params = dict (rpc_dict ["params"])     # the request is not changed
+        if "limit_max" in method_data :
+            if "limit" in params :
+                if not isinstance (params ["limit"], int) :
+                    return rpc_error (rpc_reply, RPC_PARAMETER_ERROR, "limit must be an integer")
+                if params ["limit"] > method_data ["limit_max"] :
+                    params ["limit"] = method_data ["limit_max"]
+            else :
+                params ["limit"] = method_data ["limit_max"]
+        ## Paged scans never truncate silently, the reply "next_token"
+        # is passed back as "page_token" to read the next page
+        paged = method_data.get ("paged", False)
+        if paged and params.get ("page_token") is None :
+            params ["page_token"] = ""
+        ## msgpack replies get stored msgpack rows without decoding them
+        if method_data.get ("raw", False) :
+            params ["raw"] = request.reply_type == MSGPACK_CONTENT_TYPE
+        ## Cached reads, nothing is read if the client has the table generation
+        generation = params.pop ("generation", None)
+        if method_data.get ("cached", False) and request.generations is not None :
+            rpc_reply ["generation"] = request.generations.get (params.get ("table_name"))
+            if generation == rpc_reply ["generation"] :
+                rpc_reply ["not_modified"] = True
+                rpc_reply ["result"] = None
+                return rpc_reply
+        #print ("rpc: params", params)
+        retries = 0
+        while True :
+            self.acquire ()
+            try :
+                ## simple db function call
+                db_reply = method_data ["method"] (**params)
+                if method_data ["write"] :
+                    self.write_done (rpc_dict ["method"], params, db_reply is not False)  # False, nothing changed
+                break
+            except Exception as e :
+                if not self.retry_write (method_data, e, retries) :
+                    if method_data ["write"] :
+                        self.write_done (rpc_dict ["method"], params, True)  # rows may have changed
+                    return rpc_error (rpc_reply, RPC_DB_CALL_ERROR, str(e))
+            finally :
+                self.release ()
+            retries += 1
+        if paged :
+            rpc_reply ["next_token"] = db_reply ["next_token"]
+            db_reply = db_reply ["rows"]
+        rpc_reply ["result"] = db_reply   # reply message
+        return rpc_reply
+
+    ## Checks a request dict, returns the method set entry or None after
+    # setting the rpc_reply error
+    def check_message (self, request, rpc_dict, rpc_reply) :
         ## test for valid json rpc message
-        if "jsonrpc" not in self.rpc_dict \
-        or "method" not in self.rpc_dict \
-        or "params" not in self.rpc_dict :
-            self.rpc_error (RPC_REQUEST_ERROR)
+        if not isinstance (rpc_dict, dict) \
+        or not isinstance (rpc_dict.get ("params"), dict) \
+        or "jsonrpc" not in rpc_dict \
+        or "method" not in rpc_dict \
+        or "params" not in rpc_dict :
+            rpc_error (rpc_reply, RPC_REQUEST_ERROR)
+            return None
+        if "id" in rpc_dict :
+            rpc_reply ["id"] = rpc_dict ["id"] # don't care about "id"
+        if rpc_dict ["method"] not in request.methods :
+            rpc_error (rpc_reply, RPC_METHOD_ERROR)        # Not a valid method
             return None
-        if "id" in self.rpc_dict :
-            self.rpc_reply ["id"] = self.rpc_dict ["id"] # don't care about "id"
-        if self.rpc_dict["method"] not in self.methods :
-            self.rpc_error (RPC_METHOD_ERROR)        # Not a valid method
-            return
         ## Test for valid/allowed method
-        method_data = self.methods [self.rpc_dict["method"]]
+        method_data = request.methods [rpc_dict ["method"]]
         if not method_data ["allowed"] :
-            self.rpc_error (RPC_METHOD_ERROR)        # method not allowed
+            rpc_error (rpc_reply, RPC_METHOD_ERROR)        # method not allowed
+            return None
+        return method_data
+
+    ## Returns True if a write failed because another connection changed
+    # the same rows first, the writes are aborted and can be repeated.
+    # Only auto commit writes are retried, earlier uncommitted writes
+    # would be lost with the abort.
+    def retry_write (self, method_data, error, retries) :
+        if not method_data ["write"] \
+        or retries >= WRITE_RETRIES \
+        or not getattr (self.db, "auto_commit", False) \
+        or not hasattr (self.db, "conflict_errors") \
+        or not isinstance (error, self.db.conflict_errors ()) :
+            return False
+        self.db.abort ()
+        return True
+
+    ## After a write method, called with the database lock held
+    # Reads share the writer's connection and see uncommitted writes, so
+    # the tables written change generation now. With commit_generations
+    # they change once the writes are committed, other connections
+    # (SimpleDBWorkers readers) can not read them before
+    def write_done (self, method, params, changed) :
+        if not changed or method in COMMIT_METHODS :
+            pass
+        elif not self.commit_generations :
+            self.generations.changed (params.get ("table_name"))
+        else :
+            self.pending_tables [params.get ("table_name")] = True
+        self.commit_done ()
+    ## Changes the generations of the written tables if nothing is pending
+    def commit_done (self) :
+        if len (self.pending_tables) == 0 \
+        or getattr (self.db, "pending_writes", 0) > 0 :
             return
-        if "limit_max" in method_data :
-            if "limit" in self.rpc_dict["params"] :
-                if self.rpc_dict["params"]["limit"] > method_data["limit_max"] :
-                    self.rpc_dict["params"]["limit"] = method_data["limit_max"]
-            else :
-                self.rpc_dict["params"]["limit"] = method_data["limit_max"]
-        #print ("rpc: params", self.rpc_dict["params"])
+        if None in self.pending_tables :
+            self.generations.changed ()
+        else :
+            for _, table_name in enumerate (self.pending_tables) :
+                self.generations.changed (table_name)
+        self.pending_tables = {}
+
+    ## Database lock, held while a method runs
+    def acquire (self) :
+        self.db_lock.acquire ()
+    def release (self) :
+        self.db_lock.release ()
+
+    ## Group commit, returns how often commit_due should be called in
+    # milliseconds, None if the database does not use group commit
+    def commit_interval_ms (self) :
+        if getattr (self.db, "commit_policy", None) != COMMIT_GROUP :
+            return None
+        return self.db.group_commit_ms
+    ## Commits pending writes that are due, returns True if it committed
+    # Writes are only checked when the next write arrives, the servers
+    # call this every commit_interval_ms so a burst is not left pending
+    def commit_due (self) :
+        self.db_lock.acquire ()
         try :
-            ## simple db function call
-            db_reply = self.methods [self.rpc_dict["method"]]["method"] (**self.rpc_dict["params"])
-        except Exception as e :
-            self.rpc_error_message (RPC_DB_CALL_ERROR, str(e))
-            return
-        self.rpc_reply ["result"] = db_reply   # reply message
-        
-    def rpc_error_message (self, error_number, error_message) :
-        message_save = RPC_ERRORS [error_number]
-        RPC_ERRORS [error_number] = error_message
-        self.rpc_error (error_number)
-        RPC_ERRORS [error_number] = message_save
-    def rpc_error (self, error_number) :
-        #print ("rpc_error:", error_number)
-        self.rpc_reply ["error"] = {
-            "code" : error_number ,
-            "message" : RPC_ERRORS [error_number]
-            }
+            committed = self.db.commit_due ()
+            self.commit_done ()
+            return committed
+        finally :
+            self.db_lock.release ()
 
     ## Shut down server and database
     def shutdown (self) :
         print ("Stopping Server")
+        self.db_lock.acquire ()
         self.db.close ()         # database
+
+def main () :
+    import os
+    db_file_name = "server_test.db"
+    try :
+        os.remove (db_file_name)
+        print ("Removed:", db_file_name)
+    except :
+        pass
+    server = SimpleDBServer (db_file_name)
+    rows = 3 * STREAM_PIECE_ROWS + 7
+    for _, table_name in enumerate (("stream_a", "stream_b")) :
+        for row_number in range (rows) :
+            server.db.write_row (table_name, "id", {"id" : "%05d" % row_number, "table" : table_name})
+    ## Two streams read a piece each in turn with other requests in between,
+    # each must still get every row of its own table in key order
+    streams = {}
+    for _, table_name in enumerate (("stream_a", "stream_b")) :
+        rpc_request = json.dumps ({"jsonrpc" : "2.0" ,
+                                    "method" : "get_table_rows" ,
+                                    "params" : {"table_name" : table_name} ,
+                                    "id" : table_name})
+        streams [table_name] = (server.process_stream (rpc_request), [])
+    open_streams = list (streams.keys ())
+    while len (open_streams) > 0 :
+        for _, table_name in enumerate (list (open_streams)) :
+            stream, lines = streams [table_name]
+            try :
+                lines.extend (next (stream).splitlines ())
+            except StopIteration :
+                open_streams.remove (table_name)
+            server.process_request (json.dumps ({"jsonrpc" : "2.0" ,
+                                                    "method" : "read_row" ,
+                                                    "params" : {"table_name" : "stream_b", "key" : "00001"} ,
+                                                    "id" : 1}))
+    for _, (table_name, (stream, lines)) in enumerate (streams.items ()) :
+        stream_rows = [json.loads (line) for line in lines [:-1]]
+        in_order = [row ["id"] for row in stream_rows] == ["%05d" % row_number for row_number in range (rows)]
+        own_table = all (row ["table"] == table_name for row in stream_rows)
+        print ("interleaved stream:", table_name, len (stream_rows), "rows, in order:", in_order ,
+                "own table:", own_table, "reply:", lines [-1])
+    ## Integer map keys are strings in json and msgpack replies
+    if umsgpack is not None :
+        reply = {"result" : {0 : "customer_number", 1 : "name", "2" : None}}
+        print ("msgpack keys:", umsgpack.loads (server.encode_reply (reply, MSGPACK_CONTENT_TYPE)) ==
+                                json.loads (server.encode_reply (reply)))
+    server.shutdown ()
+
+if __name__ == "__main__" :
+    main ()
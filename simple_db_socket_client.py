@@ -0,0 +1,203 @@
+#
+################################################################################
+# The MIT License (MIT)
+#
+# Copyright (c) 2025 Curt Timmerman
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+################################################################################
+#
+#
+## SimpleDBSocketClient - SimpleDBClient for simple_db_socket_server.py
+#
+# Notes:
+#   o Same methods as SimpleDBClient, requests are sent as frames over a
+#     TCP or Unix socket (path), there is no HTTP
+#   o Up to pool_size connections are kept open and reused
+#   o stream_table_rows etc. read the rows page by page (iter_table_rows),
+#     the socket server has no streams
+#   o Runs with python and micropython (socket module), Unix sockets are
+#     python only
+#
+################################################################################
+
+import socket
+import struct
+
+from simple_db_client import SimpleDBClient, POOL_SIZE, REQUEST_TIMEOUT, CACHE_TTL, ticks_ms, ticks_diff, \
+                                umsgpack, JSON_CONTENT_TYPE, MSGPACK_CONTENT_TYPE
+
+## Frame format, see simple_db_socket_server.py
+FRAME_HEADER = ">IB"            # body length, flags
+FRAME_HEADER_SIZE = 5
+FRAME_MSGPACK = 0x01
+FRAME_ACCEPT_MSGPACK = 0x02
+
+SOCKET_PORT = 8081
+RECV_BYTES = 65536              # most bytes read by one recv
+STREAM_PAGE_ROWS = 1000         # page size of stream_table_rows etc.
+
+## Returns size bytes read from sock
+def recv_exactly (sock, size) :
+    parts = []
+    while size > 0 :
+        data = sock.recv (min (size, RECV_BYTES))
+        if not data :
+            raise OSError ("Connection closed by server")
+        parts.append (data)
+        size -= len (data)
+    return b"".join (parts)
+
+class SimpleDBSocketClient (SimpleDBClient) :
+    def __init__ (self,
+                    hostname = "localhost",
+                    port = SOCKET_PORT,
+                    use_local_date_time = True,
+                    pool_size = POOL_SIZE,
+                    timeout = REQUEST_TIMEOUT,
+                    use_msgpack = True,
+                    path = None,                # Unix socket path, hostname and port are not used
+                    cache_rows = 0,
+                    cache_ttl = CACHE_TTL) :
+        SimpleDBClient.__init__ (self, hostname, port, use_local_date_time,
+                                    pool_size, timeout, use_msgpack, cache_rows, cache_ttl)
+        self.path = path
+        self.connect_timeout = timeout
+        self.read_timeout = timeout
+        if isinstance (timeout, tuple) :
+            self.connect_timeout, self.read_timeout = timeout
+        self.accept_msgpack = use_msgpack and umsgpack is not None
+
+    ## Connections are sockets kept open between requests
+    def open_session (self) :
+        self.idle = []           # open sockets
+
+    ## Close kept connections
+    def close (self) :
+        while len (self.idle) > 0 :
+            self.idle.pop ().close ()
+
+    ## Returns (socket, reused), a kept connection or a new one
+    def open_socket (self, reuse = True) :
+        if reuse :
+            try :
+                return self.idle.pop (), True
+            except IndexError :
+                pass            # none kept
+        if self.path is not None :
+            sock = socket.socket (socket.AF_UNIX, socket.SOCK_STREAM)
+            address = self.path
+        else :
+            address_info = socket.getaddrinfo (self.hostname, self.port, 0, socket.SOCK_STREAM) [0]
+            sock = socket.socket (address_info [0], socket.SOCK_STREAM)
+            address = address_info [-1]
+            if hasattr (socket, "TCP_NODELAY") :
+                sock.setsockopt (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try :
+            sock.settimeout (self.connect_timeout)
+            sock.connect (address)
+            sock.settimeout (self.read_timeout)
+        except Exception :
+            sock.close ()
+            raise
+        self.request_stats ["connections"] += 1
+        return sock, False
+    ## Sends a request frame, returns the reply (flags, body)
+    def exchange (self, sock, frame) :
+        sock.sendall (frame)
+        body_length, flags = struct.unpack (FRAME_HEADER, recv_exactly (sock, FRAME_HEADER_SIZE))
+        return flags, recv_exactly (sock, body_length)
+
+    ## Sends json rpc request (dict or batch list) to the server
+    # The RPC reply is returned as a dict (list for a batch) or None on error
+    def send_request (self, rpc_data) :
+        sock = None
+        start_ms = ticks_ms ()
+        try :
+            flags = 0
+            if self.wire == MSGPACK_CONTENT_TYPE :
+                flags |= FRAME_MSGPACK
+            if self.accept_msgpack :
+                flags |= FRAME_ACCEPT_MSGPACK
+            body = self.encode_request (rpc_data)
+            frame = struct.pack (FRAME_HEADER, len (body), flags) + body
+            sock, reused = self.open_socket ()
+            try :
+                reply_flags, reply_body = self.exchange (sock, frame)
+            except OSError :
+                if not reused :
+                    raise
+                sock.close ()       # kept connection closed by the server, try a new one
+                sock = None
+                sock, _ = self.open_socket (reuse = False)
+                reply_flags, reply_body = self.exchange (sock, frame)
+            if len (self.idle) < self.pool_size :
+                self.idle.append (sock)
+            else :
+                sock.close ()
+            sock = None
+            if len (reply_body) == 0 :
+                return None         # notifications only
+            content_type = JSON_CONTENT_TYPE
+            if reply_flags & FRAME_MSGPACK :
+                content_type = MSGPACK_CONTENT_TYPE
+            return self.decode_reply (reply_body, content_type)
+        except Exception as e :
+            print ("socket:", e)
+            self.request_stats ["errors"] += 1
+            if sock is not None :
+                sock.close ()       # reply state unknown, do not reuse
+        finally :
+            request_ms = ticks_diff (ticks_ms (), start_ms)
+            self.request_stats ["requests"] += 1
+            self.request_stats ["total_ms"] += request_ms
+            self.request_stats ["last_ms"] = request_ms
+            if request_ms > self.request_stats ["max_ms"] :
+                self.request_stats ["max_ms"] = request_ms
+        ## report error here
+        return None
+
+    ## Generator, there are no socket streams, rows are read page by page
+    # limit is the total number of rows, Default: None, all rows
+    def iter_stream (self, method, params) :
+        limit = params.get ("limit")
+        count = 0
+        for _, result in enumerate (self.iter_pages (method, dict (params, limit = STREAM_PAGE_ROWS))) :
+            if limit is not None and count >= limit :
+                return
+            count += 1
+            yield result
+
+# end SimpleDBSocketClient  #
+
+def main () :
+    my_db = SimpleDBSocketClient ("127.0.0.1", SOCKET_PORT)
+    print (my_db.get_configuration ())
+    my_db.write_row ("customer", "customer_number" ,  {"customer_number" : "000100" ,
+                                                        "name":"Curt" ,
+                                                        "dob":19560606 ,
+                                                        "occupation":"retired"})
+    print ("read_row:", my_db.read_row ("customer", "000100"))
+    for _ in range (1000) :
+        my_db.read_row ("customer", "000100")
+    print ("request stats:", my_db.get_request_stats ())
+    my_db.close ()
+
+if __name__ == "__main__" :
+    main ()
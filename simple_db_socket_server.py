@@ -0,0 +1,145 @@
+#
+################################################################################
+# The MIT License (MIT)
+#
+# Copyright (c) 2025 Curt Timmerman
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+################################################################################
+#
+################################################################################
+# simple_db_socket_server - json rpc over a TCP or Unix socket (asyncio)
+#   o No HTTP, each request and reply is one frame:
+#       4 byte length (big endian), 1 byte flags, body
+#   o flags FRAME_MSGPACK, the body is msgpack, otherwise json
+#     flags FRAME_ACCEPT_MSGPACK (requests only), the reply may be msgpack
+#   o A request with only notifications gets an empty reply frame
+#   o Connections are kept open, requests on a connection are answered
+#     in order
+#   o Runs with python and micropython asyncio, Unix sockets are python only
+#   o Use simple_db_socket_client.py SimpleDBSocketClient
+################################################################################
+#
+
+import struct
+
+import asyncio
+
+from simple_db_server import SimpleDBServer, JSON_CONTENT_TYPE, MSGPACK_CONTENT_TYPE, \
+                                RPC_REQUEST_ERROR, rpc_error, rpc_reply_dict
+
+## Frame format, see simple_db_socket_client.py
+FRAME_HEADER = ">IB"            # body length, flags
+FRAME_HEADER_SIZE = 5
+FRAME_MSGPACK = 0x01
+FRAME_ACCEPT_MSGPACK = 0x02
+FRAME_MAX_BYTES = 1048576       # larger requests are refused, the connection is closed
+
+SOCKET_HOST = "0.0.0.0"
+SOCKET_PORT = 8081
+SOCKET_PATH = None              # Unix socket path, e.g. "/tmp/simple_db.sock" (python only)
+
+## python runs requests in threads so requests on different connections
+# can run at the same time, micropython runs them one at a time
+USE_THREADS = hasattr (asyncio, "to_thread")
+
+################################################################################
+
+db = SimpleDBServer ()
+
+## python, SimpleDBBtrees with several readers
+#from simple_db_workers import SimpleDBWorkers
+#db = SimpleDBWorkers ("server_test.fs", workers = 4)
+
+## Returns the reply dict for a request body, None for notifications
+async def process_request (body, content_type, reply_type) :
+    if USE_THREADS :
+        return await asyncio.to_thread (db.process_request, body ,
+                                        content_type = content_type ,
+                                        reply_type = reply_type)
+    return db.process_request (body ,
+                                content_type = content_type ,
+                                reply_type = reply_type)
+
+## Sends one frame, header and body in one write so they are not
+# sent as separate packets
+async def send_frame (writer, body, flags) :
+    writer.write (struct.pack (FRAME_HEADER, len (body), flags) + body)
+    await writer.drain ()
+
+## Answers the requests on one connection until the client closes it
+async def handle_connection (reader, writer) :
+    try :
+        while True :
+            header = await reader.readexactly (FRAME_HEADER_SIZE)
+            body_length, flags = struct.unpack (FRAME_HEADER, header)
+            if body_length > FRAME_MAX_BYTES :
+                reply = rpc_error (rpc_reply_dict (), RPC_REQUEST_ERROR, "Request too large")
+                await send_frame (writer, db.encode_reply (reply), 0)
+                break
+            body = await reader.readexactly (body_length)
+            content_type = JSON_CONTENT_TYPE
+            if flags & FRAME_MSGPACK :
+                content_type = MSGPACK_CONTENT_TYPE
+            reply_type = JSON_CONTENT_TYPE
+            if flags & FRAME_ACCEPT_MSGPACK :
+                reply_type = db.reply_content_type (MSGPACK_CONTENT_TYPE)
+            reply = await process_request (body, content_type, reply_type)
+            if reply is None :
+                await send_frame (writer, b"", 0)      # notifications only
+            elif reply_type == MSGPACK_CONTENT_TYPE :
+                await send_frame (writer, db.encode_reply (reply, reply_type), FRAME_MSGPACK)
+            else :
+                await send_frame (writer, db.encode_reply (reply), 0)
+    except (EOFError, OSError) :
+        pass                # client closed the connection
+    finally :
+        writer.close ()
+        await writer.wait_closed ()
+
+## Group commit, pending writes are committed when they are due even if
+# no more writes arrive
+async def commit_task (interval_ms) :
+    while True :
+        await asyncio.sleep (interval_ms / 1000)
+        if USE_THREADS :
+            await asyncio.to_thread (db.commit_due)
+        else :
+            db.commit_due ()
+
+async def main () :
+    interval_ms = db.commit_interval_ms ()
+    if interval_ms is not None :
+        asyncio.create_task (commit_task (interval_ms))
+    if SOCKET_PATH is not None :
+        server = await asyncio.start_unix_server (handle_connection, SOCKET_PATH)
+    else :
+        server = await asyncio.start_server (handle_connection, SOCKET_HOST, SOCKET_PORT)
+    try :
+        while True :
+            await asyncio.sleep (3600)
+    finally :
+        server.close ()
+
+try :
+    asyncio.run (main ())
+except KeyboardInterrupt :
+    pass
+finally :
+    db.shutdown ()
@@ -0,0 +1,173 @@
+#
+################################################################################
+# The MIT License (MIT)
+#
+# Copyright (c) 2025 Curt Timmerman
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+################################################################################
+#
+################################################################################
+# SimpleDBWorkers - SimpleDBBtrees server with several readers (python only)
+#   o Reads run at the same time on separate ZODB connections (threads)
+#     or in separate worker processes (processes = True, needs ZEO)
+#   o Writes run on one writer connection, conflicts are retried
+#   o Readers see committed writes only, use commit_policy auto (default)
+#   o Used in place of SimpleDBServer:
+#       db = SimpleDBWorkers ("server_test.fs", workers = 4)
+#   o Processes need a ZEO server (pip install ZEO), FileStorage can only
+#     be opened by one process:
+#       runzeo -a 8100 -f server_test.fs
+#       db = SimpleDBWorkers ("zeo://localhost:8100", workers = 4, processes = True)
+################################################################################
+#
+
+import queue
+import multiprocessing
+
+from simple_db_btrees import SimpleDBBtrees, open_btrees_db, ZEO_PREFIX
+from simple_db_server import SimpleDBServer, RPCRequest, WRITE_METHODS, JSON_CONTENT_TYPE, \
+                                RPC_PARSE_ERROR, RPC_INTERNAL_ERROR, \
+                                rpc_error, rpc_reply_dict, decode_request
+
+WORKERS = 4
+
+## Returns True if a decoded request (dict or batch list) has a write method
+def is_write_request (rpc_data) :
+    if not isinstance (rpc_data, list) :
+        rpc_data = [rpc_data]
+    for _, rpc_dict in enumerate (rpc_data) :
+        if isinstance (rpc_dict, dict) and rpc_dict.get ("method") in WRITE_METHODS :
+            return True
+    return False
+
+## Returns a read only server, its own database connection
+def open_reader (db_file_path, btrees_db, db_options) :
+    return SimpleDBServer (db = SimpleDBBtrees (db_file_path ,
+                                                btrees_db = btrees_db ,
+                                                read_only = True ,
+                                                **db_options))
+
+## Returns the reply of a reader, sync shows the latest committed writes
+# generations is the writer TableGenerations copy, taken before sync so
+# replies never have a newer generation than their rows
+def read_request (reader, rpc_data, methods, reply_type, generations) :
+    request = RPCRequest (reader.get_methods (methods), reply_type, generations)
+    reader.db.sync ()
+    return reader.process_data (request, rpc_data)
+
+## Worker process, replies to (rpc_data, methods, reply_type, generations)
+# messages until None is received. The database is opened by the first
+# request, the writer has created it by then.
+def worker_main (connection, db_file_path, db_options) :
+    reader = None
+    while True :
+        message = connection.recv ()
+        if message is None :
+            break
+        if reader is None :
+            reader = open_reader (db_file_path, None, db_options)
+        rpc_data, methods, reply_type, generations = message
+        try :
+            connection.send (read_request (reader, rpc_data, methods, reply_type, generations))
+        except Exception as e :
+            connection.send (rpc_error (rpc_reply_dict (), RPC_INTERNAL_ERROR, str (e)))
+    if reader is not None :
+        reader.db.close ()
+    connection.close ()
+
+class SimpleDBWorkers :
+    def __init__ (self ,
+                    db_file_path = "server_test.fs" ,
+                    workers = WORKERS ,         # readers
+                    processes = False ,         # readers are processes, needs ZEO
+                    **db_options) :             # SimpleDBBtrees options, e.g. cache_rows
+        if processes and not db_file_path.startswith (ZEO_PREFIX) :
+            raise ValueError ("Worker processes need a ZEO server: " + ZEO_PREFIX + "host:port")
+        self.processes = []
+        self.readers = queue.Queue ()
+        ## Worker processes start before any database is open here
+        for _ in range (workers if processes else 0) :
+            connection, worker_connection = multiprocessing.Pipe ()
+            process = multiprocessing.Process (target = worker_main ,
+                                    args = (worker_connection, db_file_path, db_options) ,
+                                    daemon = True)
+            process.start ()
+            self.processes.append (process)
+            self.readers.put (connection)
+        ## Writer, its connection also serves streams
+        self.btrees_db = open_btrees_db (db_file_path)
+        self.btrees_db.setPoolSize (workers + 1)
+        self.writer = SimpleDBServer (db = SimpleDBBtrees (db_file_path ,
+                                                    btrees_db = self.btrees_db ,
+                                                    **db_options) ,
+                                        commit_generations = True)
+        self.writer.db.commit ()          # new database is visible to readers
+        for _ in range (0 if processes else workers) :
+            self.readers.put (open_reader (db_file_path, self.btrees_db, db_options))
+
+    ## SimpleDBServer.process_request, reads are sent to a free reader
+    def process_request (self, rpc_request, methods = None ,
+                            content_type = None ,
+                            reply_type = None) :
+        if reply_type is None :
+            reply_type = JSON_CONTENT_TYPE
+        try :
+            rpc_data = decode_request (rpc_request, content_type)
+        except :
+            return rpc_error (rpc_reply_dict (), RPC_PARSE_ERROR)
+        generations = self.writer.generations.copy ()
+        if is_write_request (rpc_data) :
+            request = RPCRequest (self.writer.get_methods (methods), reply_type, generations)
+            return self.writer.process_data (request, rpc_data)
+        reader = self.readers.get ()      # waits for a free reader
+        try :
+            if self.processes :
+                reader.send ((rpc_data, methods, reply_type, generations))
+                return reader.recv ()
+            return read_request (reader, rpc_data, methods, reply_type, generations)
+        finally :
+            self.readers.put (reader)
+
+    def reply_content_type (self, accept = None) :
+        return self.writer.reply_content_type (accept)
+    def encode_reply (self, reply, reply_type = JSON_CONTENT_TYPE) :
+        return self.writer.encode_reply (reply, reply_type)
+    ## Group commit is done by the writer
+    def commit_interval_ms (self) :
+        return self.writer.commit_interval_ms ()
+    def commit_due (self) :
+        return self.writer.commit_due ()
+    ## Streams are read by the writer connection
+    def process_stream (self, rpc_request, methods = None) :
+        return self.writer.process_stream (rpc_request, methods)
+
+    ## Shut down workers, writer and database
+    def shutdown (self) :
+        while not self.readers.empty () :
+            reader = self.readers.get ()
+            if self.processes :
+                reader.send (None)
+                reader.close ()
+            else :
+                reader.db.close ()
+        for _, process in enumerate (self.processes) :
+            process.join ()
+        self.writer.shutdown ()
+        self.btrees_db.close ()
@@ -0,0 +1,143 @@
+## AsyncSimpleDBClient tests against a small asyncio HTTP server
+# The server passes requests to SimpleDBServer with a simple_db_btrees database
+import asyncio
+
+import pytest
+
+pytest.importorskip ("BTrees")
+pytest.importorskip ("ZODB")
+
+from simple_db_btrees import SimpleDBBtrees
+from simple_db_server import SimpleDBServer, decode_request
+from simple_db_async_client import AsyncSimpleDBClient
+
+## LocalServer - HTTP server for one test
+#   keep_alive False replies HTTP/1.0 and closes, as simple_db_microdot.py does
+#   drop_request n runs the n-th request of each connection, then closes
+#   the connection without a reply
+class LocalServer :
+    def __init__ (self, db, keep_alive = True, drop_request = None) :
+        self.server = SimpleDBServer (db = db)
+        self.keep_alive = keep_alive
+        self.drop_request = drop_request
+        self.requests = []          # decoded json rpc requests, in arrival order
+        self.connections = 0
+        self.listener = None
+        self.port = None
+
+    async def start (self) :
+        self.listener = await asyncio.start_server (self.handle, "127.0.0.1", 0)
+        self.port = self.listener.sockets [0].getsockname () [1]
+    async def stop (self) :
+        self.listener.close ()
+        await self.listener.wait_closed ()
+
+    async def handle (self, reader, writer) :
+        self.connections += 1
+        connection_requests = 0
+        try :
+            while True :
+                request_line = await reader.readline ()
+                if len (request_line) == 0 :
+                    break
+                headers = {}
+                while True :
+                    line = await reader.readline ()
+                    if line in (b"\r\n", b"") :
+                        break
+                    name, _, value = line.decode ().partition (":")
+                    headers [name.strip ().lower ()] = value.strip ()
+                body = await reader.readexactly (int (headers ["content-length"]))
+                content_type = headers.get ("content-type")
+                reply_type = self.server.reply_content_type (headers.get ("accept"))
+                reply = self.server.process_request (body, content_type = content_type ,
+                                                        reply_type = reply_type)
+                self.requests.append (decode_request (body, content_type))
+                connection_requests += 1
+                if connection_requests == self.drop_request :
+                    break                       # ran the calls, no reply
+                reply_body = self.server.encode_reply (reply, reply_type)
+                version = b"HTTP/1.1" if self.keep_alive else b"HTTP/1.0"
+                writer.write (version + b" 200 OK\r\nContent-Type: " + reply_type.encode ()
+                                + b"\r\nContent-Length: " + str (len (reply_body)).encode ()
+                                + b"\r\n\r\n" + reply_body)
+                await writer.drain ()
+                if not self.keep_alive :
+                    break
+        finally :
+            writer.close ()
+
+    ## Methods of every call received, batches are flattened
+    def methods (self) :
+        methods = []
+        for _, rpc_data in enumerate (self.requests) :
+            if isinstance (rpc_data, dict) :
+                rpc_data = [rpc_data]
+            methods.extend ([rpc_dict ["method"] for rpc_dict in rpc_data])
+        return methods
+
+@pytest.fixture
+def db (tmp_path) :
+    my_db = SimpleDBBtrees (str (tmp_path / "async.fs"))
+    for number in range (20) :
+        my_db.write_row ("customer", "id", {"id" : "%03d" % number, "n" : number})
+    yield my_db
+    my_db.close ()
+
+## Runs test_body (client, server) with a started server and a client for it
+def run_client (db, test_body, pool_size = 4, **server_options) :
+    async def main () :
+        server = LocalServer (db, **server_options)
+        await server.start ()
+        client = AsyncSimpleDBClient ("127.0.0.1", server.port, pool_size = pool_size, timeout = 5)
+        try :
+            await test_body (client, server)
+        finally :
+            await client.close ()
+            await server.stop ()
+    asyncio.run (main ())
+
+def test_concurrent_calls_are_batched (db) :
+    async def body (client, server) :
+        rows = await asyncio.gather (*[client.read_row ("customer", "%03d" % number)
+                                        for number in range (20)])
+        assert [row ["n"] for row in rows] == list (range (20))
+        stats = client.get_request_stats ()
+        assert stats ["calls"] == 20
+        assert stats ["requests"] < 20           # calls queued behind the first are batched
+        assert len (server.methods ()) == 20
+    run_client (db, body, pool_size = 1)
+
+def test_keep_alive_connection_is_reused (db) :
+    async def body (client, server) :
+        for number in range (3) :
+            assert (await client.read_row ("customer", "%03d" % number)) ["n"] == number
+        assert server.connections == 1
+        assert client.get_request_stats () ["connections"] == 1
+    run_client (db, body)
+
+def test_closed_connections_are_not_reused (db) :
+    async def body (client, server) :
+        for number in range (3) :
+            assert (await client.read_row ("customer", "%03d" % number)) ["n"] == number
+        assert server.connections == 3
+        assert client.get_request_stats () ["connections"] == 3
+    run_client (db, body, keep_alive = False)
+
+def test_read_is_retried_on_a_closed_idle_connection (db) :
+    async def body (client, server) :
+        assert (await client.read_row ("customer", "001")) ["n"] == 1
+        assert (await client.read_row ("customer", "002")) ["n"] == 2   # dropped, then retried
+        assert server.methods () == ["read_row", "read_row", "read_row"]
+        assert client.get_request_stats () ["errors"] == 0
+    run_client (db, body, pool_size = 1, drop_request = 2)
+
+def test_write_is_not_resent (db) :
+    async def body (client, server) :
+        assert (await client.read_row ("customer", "001")) ["n"] == 1
+        result = await client.write_row ("customer", "id", {"id" : "100", "n" : 100})
+        assert result is None                    # no reply, the write may have run
+        assert server.methods () == ["read_row", "write_row"]
+        assert client.get_request_stats () ["errors"] == 1
+        assert db.read_row ("customer", "100") == {"id" : "100", "n" : 100}
+    run_client (db, body, pool_size = 1, drop_request = 2)
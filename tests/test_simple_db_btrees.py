@@ -0,0 +1,286 @@
+## simple_db_btrees tests, run with: python -m pytest -q
+# simple_db_btrees runs on CPython without the MicroPython btree module,
+# SimpleDBServer and SimpleDBClient are tested with it in process
+import json
+
+import pytest
+
+pytest.importorskip ("BTrees")
+pytest.importorskip ("ZODB")
+
+from simple_db_btrees import SimpleDBBtrees, UniqueIndexError, COMMIT_MANUAL
+from simple_db_server import SimpleDBServer, RPC_METHOD_ERROR, RPC_REQUEST_ERROR, \
+                                RPC_PARSE_ERROR, RPC_DB_CALL_ERROR
+from simple_db_client import SimpleDBClient
+
+## Database with customer rows "001" ... "009"
+@pytest.fixture
+def db (tmp_path) :
+    my_db = SimpleDBBtrees (str (tmp_path / "test.fs"))
+    for number in range (1, 10) :
+        my_db.write_row ("customer", "id", {"id" : "%03d" % number, "n" : number})
+    my_db.write_row ("other", "id", {"id" : "001"})
+    yield my_db
+    my_db.close ()
+
+def row_ids (rows) :
+    return [row ["id"] for row in rows]
+
+def rpc (method, params, rpc_id = 1) :
+    return {"jsonrpc" : "2.0", "method" : method, "params" : params, "id" : rpc_id}
+
+## Server requests go through process_request as the HTTP servers send them
+def server_call (server, rpc_data) :
+    return server.process_request (json.dumps (rpc_data))
+
+## Ranges and cursors
+
+def test_range_bounds_are_inclusive (db) :
+    assert list (db.iter_table_keys ("customer", "003", "005")) == ["003", "004", "005"]
+    assert row_ids (db.iter_table_rows ("customer", "008")) == ["008", "009"]
+    assert row_ids (db.iter_table_rows ("customer", None, "002")) == ["001", "002"]
+
+def test_range_stays_in_table (db) :
+    assert len (list (db.iter_table_keys ("customer"))) == 9
+    assert list (db.iter_table_keys ("other")) == ["001"]
+    assert list (db.iter_table_keys ("missing")) == []
+
+def test_range_limits (db) :
+    assert list (db.iter_table_keys ("customer", limit = 2)) == ["001", "002"]
+    assert list (db.iter_table_keys ("customer", limit = 0)) == []
+    assert list (db.iter_table_keys ("customer", "005", "004")) == []
+
+def test_range_where_and_columns (db) :
+    rows = list (db.iter_table_rows ("customer", where = {"gt" : ["n", 7]}, columns = ["n"]))
+    assert rows == [{"n" : 8}, {"n" : 9}]
+    items = list (db.iter_table_items ("customer", "002", "003"))
+    assert items == [["customer.002", {"id" : "002", "n" : 2}], ["customer.003", {"id" : "003", "n" : 3}]]
+
+def test_cursor_fetch_and_seek (db) :
+    cursor = db.cursor ("customer", "002", "006")
+    assert cursor.fetch_one () ["id"] == "002"
+    assert row_ids (cursor.fetch_many (2)) == ["003", "004"]
+    assert cursor.key == "004"
+    assert row_ids (cursor.fetch_many (10)) == ["005", "006"]
+    assert cursor.fetch_one () is None
+    cursor.seek ("004")
+    assert cursor.fetch_one () ["id"] == "004"
+    cursor.seek ("000")                          # below the range, starts at the range
+    assert cursor.fetch_one () ["id"] == "002"
+    cursor.seek ("0035")                         # not a key, next key
+    assert cursor.fetch_one () ["id"] == "004"
+
+def test_cursor_reverse (db) :
+    cursor = db.cursor ("customer", "002", "005", reverse = True)
+    assert row_ids (cursor.fetch_many (3)) == ["005", "004", "003"]
+    assert row_ids (cursor.fetch_many (3)) == ["002"]
+    cursor.seek ("0035")
+    assert cursor.fetch_one () ["id"] == "003"
+
+def test_cursor_sees_writes_between_fetches (db) :
+    cursor = db.cursor ("customer")
+    assert row_ids (cursor.fetch_many (2)) == ["001", "002"]
+    db.delete_row ("customer", "003")
+    db.write_row ("customer", "id", {"id" : "0025", "n" : 25})
+    db.write_row ("customer", "id", {"id" : "0015", "n" : 15})   # before the cursor
+    assert row_ids (cursor.fetch_many (3)) == ["0025", "004", "005"]
+
+## Indexes and uniqueness
+
+def test_index_follows_writes (db) :
+    db.create_index ("customer", "city")
+    db.write_row ("customer", "id", {"id" : "001", "n" : 1, "city" : "Reno"})
+    db.write_row ("customer", "id", {"id" : "002", "n" : 2, "city" : "Reno"})
+    db.write_row ("customer", "id", {"id" : "003", "n" : 3, "city" : "Elko"})
+    assert row_ids (db.read_rows_by_index ("customer", "city", "Reno")) == ["001", "002"]
+    db.rewrite_row ("customer", "002", {"city" : "Elko"})
+    assert row_ids (db.read_rows_by_index ("customer", "city", "Reno")) == ["001"]
+    assert row_ids (db.read_rows_by_index ("customer", "city", "Elko")) == ["002", "003"]
+    db.delete_row ("customer", "003")
+    assert row_ids (db.read_rows_by_index ("customer", "city", "Elko")) == ["002"]
+    assert db.drop_index ("customer", "city")
+    with pytest.raises (KeyError) :
+        db.read_rows_by_index ("customer", "city", "Elko")
+
+def test_index_built_for_existing_rows (db) :
+    db.create_index ("customer", "n")
+    assert row_ids (db.read_rows_by_index ("customer", "n", {"start" : 3, "end" : 5})) == ["003", "004", "005"]
+
+def test_unique_index (db) :
+    db.create_index ("customer", "email", unique = True)
+    db.write_row ("customer", "id", {"id" : "001", "email" : "a"})
+    db.write_row ("customer", "id", {"id" : "002", "email" : "b"})
+    with pytest.raises (UniqueIndexError) :
+        db.write_row ("customer", "id", {"id" : "003", "email" : "a"})
+    with pytest.raises (UniqueIndexError) :
+        db.rewrite_row ("customer", "002", {"email" : "a"})
+    assert db.read_row ("customer", "002") ["email"] == "b"
+    assert db.rewrite_row ("customer", "999", {"email" : "z"}) is None   # no row
+    db.write_row ("customer", "id", {"id" : "001", "email" : "c"})      # same row, new value
+    db.write_row ("customer", "id", {"id" : "003", "email" : "a"})      # "a" is free again
+    assert row_ids (db.read_rows_by_index ("customer", "email", "a")) == ["003"]
+
+def test_unique_index_not_created_over_duplicates (db) :
+    db.write_row ("customer", "id", {"id" : "001", "group" : "x"})
+    db.write_row ("customer", "id", {"id" : "002", "group" : "x"})
+    with pytest.raises (ValueError) :
+        db.create_index ("customer", "group", unique = True)
+    assert "group" not in db.indexes.get ("customer", {})
+    db.write_row ("customer", "id", {"id" : "003", "group" : "x"})
+    db.create_index ("customer", "group")
+    assert row_ids (db.read_rows_by_index ("customer", "group", "x")) == ["001", "002", "003"]
+
+## write_rows
+
+def test_write_rows (db) :
+    rows = [{"id" : "012", "n" : 12}, {"id" : "010", "n" : 10}, {"id" : "011", "n" : 11}]
+    assert db.write_rows ("customer", "id", rows) == 3
+    assert list (db.iter_table_keys ("customer", "010")) == ["010", "011", "012"]
+    assert db.delete_rows ("customer", ["010", "011", "999"]) == 2
+
+def test_write_rows_writes_nothing_on_error (tmp_path) :
+    my_db = SimpleDBBtrees (str (tmp_path / "rows.fs"), commit_policy = COMMIT_MANUAL)
+    my_db.create_index ("customer", "email", unique = True)
+    my_db.write_rows ("customer", "id", [{"id" : "1", "email" : "a"}])
+    my_db.commit ()
+    bad_batches = (
+        [{"id" : "2", "email" : "b"}, {"id" : "3", "email" : "a"}],    # stored value
+        [{"id" : "2", "email" : "b"}, {"id" : "3", "email" : "b"}],    # within the batch
+        [{"id" : "2", "email" : "b"}, {"email" : "c"}]                 # no key
+        )
+    for _, rows in enumerate (bad_batches) :
+        with pytest.raises (Exception) :
+            my_db.write_rows ("customer", "id", rows)
+    my_db.commit ()
+    assert list (my_db.iter_table_keys ("customer")) == ["1"]
+    assert row_ids (my_db.read_rows_by_index ("customer", "email", "b")) == []
+    ## A batch moving a unique value between its rows is valid
+    my_db.write_rows ("customer", "id", [{"id" : "1", "email" : "x"}, {"id" : "2", "email" : "a"}])
+    assert row_ids (my_db.read_rows_by_index ("customer", "email", "a")) == ["2"]
+    my_db.close ()
+
+## bulk_load
+
+def test_bulk_load_round_trip (db, tmp_path) :
+    dump_path = str (tmp_path / "dump.txt")
+    db.create_index ("customer", "n")
+    db.set_schema ("order", ["id", "total"])
+    db.write_row ("order", "id", {"id" : "A1", "total" : "10.50"})
+    db.dump_all (dump_path)
+    new_db = SimpleDBBtrees (str (tmp_path / "loaded.fs"), codec = "umsgpack")
+    counters = new_db.bulk_load (dump_path, batch_size = 4)
+    assert counters ["rows"] > 0
+    for _, table_name in enumerate (("customer", "other", "order")) :
+        assert new_db.get_table_rows (table_name) == db.get_table_rows (table_name)
+        assert new_db.count_rows (table_name) == db.count_rows (table_name)
+    assert row_ids (new_db.read_rows_by_index ("customer", "n", 4)) == ["004"]
+    new_db.close ()
+
+## Paging tokens
+
+def test_paging_tokens (db) :
+    keys = []
+    page = db.get_table_keys ("customer", limit = 4, page_token = "")
+    while True :
+        keys.extend (page ["rows"])
+        if page ["next_token"] is None :
+            break
+        page = db.get_table_keys ("customer", limit = 4, page_token = page ["next_token"])
+    assert keys == list (db.iter_table_keys ("customer"))
+    ## A token from another range starts at the start of this one
+    token = db.get_table_rows ("customer", limit = 1, page_token = "") ["next_token"]
+    assert db.get_table_rows ("other", limit = 5, page_token = token) ["rows"] == [{"id" : "001"}]
+
+def test_server_paging_clamps_limit (db) :
+    server = SimpleDBServer (db = db)
+    rows = []
+    params = {"table_name" : "customer", "limit" : 5}
+    while True :
+        reply = server_call (server, rpc ("get_table_rows", params))
+        rows.extend (reply ["result"])
+        if reply ["next_token"] is None :
+            break
+        params = dict (params, page_token = reply ["next_token"])
+    assert row_ids (rows) == ["%03d" % number for number in range (1, 10)]
+    reply = server_call (server, rpc ("get_table_rows", {"table_name" : "customer", "limit" : "5"}))
+    assert "error" in reply
+
+## Batch error replies
+
+def test_batch_error_replies (db) :
+    server = SimpleDBServer (db = db)
+    replies = server_call (server, [
+        rpc ("read_row", {"table_name" : "customer", "key" : "001"}, 1) ,
+        rpc ("no_such_method", {}, 2) ,
+        {"jsonrpc" : "2.0", "method" : "read_row", "id" : 3} ,      # no params
+        {"jsonrpc" : "2.0", "method" : "read_row", "params" : {"table_name" : "customer", "key" : "002"}} ,
+        rpc ("read_row", {"table_name" : "customer"}, 5)          # bad params
+        ])
+    assert [reply.get ("id") for reply in replies] == [1, 2, None, 5]
+    assert replies [0] ["result"] ["n"] == 1
+    assert replies [1] ["error"] ["code"] == RPC_METHOD_ERROR
+    assert replies [2] ["error"] ["code"] == RPC_REQUEST_ERROR
+    assert replies [3] ["error"] ["code"] == RPC_DB_CALL_ERROR
+    assert server_call (server, []) ["error"] ["code"] == RPC_REQUEST_ERROR
+    assert server.process_request ("[{") ["error"] ["code"] == RPC_PARSE_ERROR
+    notification = {"jsonrpc" : "2.0", "method" : "row_exists", "params" : {"table_name" : "customer", "key" : "001"}}
+    assert server_call (server, [notification]) is None
+
+## not_modified revalidation
+
+def test_not_modified (db) :
+    server = SimpleDBServer (db = db)
+    read = rpc ("read_row", {"table_name" : "customer", "key" : "001"})
+    reply = server_call (server, read)
+    generation = reply ["generation"]
+    read ["params"] ["generation"] = generation
+    reply = server_call (server, read)
+    assert reply ["not_modified"] and reply ["result"] is None
+    server_call (server, rpc ("write_row", {"table_name" : "other", "pk_id" : "id", "row_data" : {"id" : "002"}}))
+    assert server_call (server, read) ["not_modified"]       # another table
+    server_call (server, rpc ("rewrite_row", {"table_name" : "customer", "key" : "001", "update_data" : {"n" : 100}}))
+    reply = server_call (server, read)
+    assert "not_modified" not in reply
+    assert reply ["result"] ["n"] == 100 and reply ["generation"] != generation
+
+def test_generation_changes_at_write_without_commit (tmp_path) :
+    server = SimpleDBServer (db = SimpleDBBtrees (str (tmp_path / "manual.fs"), commit_policy = COMMIT_MANUAL))
+    read = rpc ("read_row", {"table_name" : "customer", "key" : "001"})
+    generation = server_call (server, read) ["generation"]
+    server_call (server, rpc ("write_row", {"table_name" : "customer", "pk_id" : "id", "row_data" : {"id" : "001"}}))
+    read ["params"] ["generation"] = generation
+    reply = server_call (server, read)
+    assert "not_modified" not in reply and reply ["result"] == {"id" : "001"}
+    server.shutdown ()
+
+## SimpleDBClient with the server called in process
+class InProcessClient (SimpleDBClient) :
+    def __init__ (self, server, **client_options) :
+        SimpleDBClient.__init__ (self, **client_options)
+        self.server = server
+        self.sent = []
+    def send_request (self, rpc_data) :
+        self.sent.append (rpc_data)
+        return json.loads (json.dumps (server_call (self.server, rpc_data)))
+
+def test_client_cache_revalidates (db) :
+    server = SimpleDBServer (db = db)
+    client = InProcessClient (server, cache_rows = 10, cache_ttl = 0)
+    assert client.read_row ("customer", "001") ["n"] == 1
+    assert client.read_row ("customer", "001") ["n"] == 1
+    assert client.sent [-1] ["params"] ["generation"] is not None
+    stats = client.get_read_cache_stats ()
+    assert (stats ["misses"], stats ["revalidated"]) == (1, 1)
+    db.rewrite_row ("customer", "001", {"n" : 50})     # not sent by this client
+    server.generations.changed ("customer")
+    assert client.read_row ("customer", "001") ["n"] == 50
+    client.write_row ("customer", "id", {"id" : "001", "n" : 60})
+    assert client.read_row ("customer", "001") ["n"] == 60
+    assert client.get_read_cache_stats () ["misses"] == 3
+
+def test_client_cache_ttl (db) :
+    client = InProcessClient (SimpleDBServer (db = db), cache_rows = 10, cache_ttl = 60)
+    client.read_row ("customer", "002")
+    client.read_row ("customer", "002")
+    assert len (client.sent) == 1
+    assert client.get_read_cache_stats () ["hits"] == 1